@@ -0,0 +1,148 @@
+import logging
+import random
+from dataclasses import dataclass, fields
+
+from PIL import Image, ImageOps
+
+from constants import *
+import key_expr
+from main import PixelSort
+from options import Options
+from sorting import SortingEngine
+
+# In-memory API for using PixelSort from other Python code.
+# Nothing is read from or written to disk and logging is not configured,
+# every call has its own options, engine and random generator, so calls
+# can be made repeatedly and from several threads at the same time.
+
+logger = logging.getLogger("pixelsort.api")
+
+@dataclass
+class SortOptions:
+    """
+    Sorting parameters. Names and values are the same as of command line arguments
+    with long names, for example segmentation="chunky" is the same as --segmentation chunky.
+    """
+    segmentation: str = OPTION_DEFAULTS["segmentation"]
+    skey_choice: str = OPTION_DEFAULTS["skey_choice"]
+    # sorting key expression, used instead of skey_choice if it is not empty
+    skey_expr: str = OPTION_DEFAULTS["skey_expr"]
+    threshold: float = OPTION_DEFAULTS["threshold"]
+    offset: int = OPTION_DEFAULTS["offset"]
+    edge_detector: str = OPTION_DEFAULTS["edge_detector"]
+    angle: int = OPTION_DEFAULTS["angle"]
+    sangle: int = OPTION_DEFAULTS["sangle"]
+    size: float = OPTION_DEFAULTS["size"]
+    randomness: float = OPTION_DEFAULTS["randomness"]
+    length: float = OPTION_DEFAULTS["length"]
+    scale: float = OPTION_DEFAULTS["scale"]
+    width: int = OPTION_DEFAULTS["width"]
+    height: int = OPTION_DEFAULTS["height"]
+    engine: str = OPTION_DEFAULTS["engine"]
+    sort_backend: str = OPTION_DEFAULTS["sort_backend"]
+    threads: int = OPTION_DEFAULTS["threads"]
+    second_pass: bool = False
+    reverse: bool = False
+    preserve_res: bool = False
+    rotation_free: bool = False
+    symmetry: bool = False
+    decompose: bool = False
+    # seed of random segmentations, output is repeatable if it is set
+    seed: int = None
+
+    def to_options(self) -> Options:
+        """
+        Validate values and convert them to Options object.
+
+        :returns: Options object
+        :rtype: Options
+        """
+        options = Options()
+        by_name = {option.name: option for option in options.__dict__.values()}
+
+        for option in by_name.values():
+            option.set_to_default()
+
+        for field in fields(self):
+            option = by_name[field.name]
+            value = getattr(self, field.name)
+
+            # options without default, like seed, may stay unset
+            if value is None and option.default is None:
+                continue
+
+            if option.val_type == float and isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+
+            if not isinstance(value, option.val_type) or option.val_type != bool and isinstance(value, bool):
+                raise TypeError(f"{field.name} should be {option.val_type.__name__}, got {value!r}")
+
+            if option.choices is not None and value not in option.choices:
+                raise ValueError(f"{field.name} should be one of {', '.join(option.choices)}, got {value!r}")
+
+            if not option.check_value(value):
+                raise ValueError(f"{field.name} value {value!r} is out of bounds {option.bounds}")
+
+            option.value = value
+            if option.isvariable:
+                option.keyframes = (value, value)
+
+        if options.se.value:
+            try:
+                key_expr.parse(options.se.value)
+            except ValueError as e:
+                raise ValueError(f"skey_expr {options.se.value!r} is invalid: {e}") from None
+
+        # same as command line, these options work only with numpy engine
+        if options.en.value != "numpy":
+            options.sb.set_to_default()
+            options.rf.set_to_default()
+            options.th.set_to_default()
+
+        return options
+
+def sort_image(image, options: SortOptions=None, *, mask=None, use_tables: bool=False):
+    """
+    Sort pixels of image.
+
+    :param image: Image object or (height, width, 3) uint8 array, it is not changed
+    :param options: SortOptions object, if None, default options are used
+    :type options: SortOptions
+    :param mask: Mask as Image object or (height, width) array, only white parts are sorted
+    :param use_tables: Look up hue, lightness, saturation and expressions with them in tables
+                       cached on disk, it is faster, but writes cache folder. Works only with numpy engine.
+    :type use_tables: bool
+
+    :returns: Sorted image, Image object or array like image argument
+    """
+    options = options if options is not None else SortOptions()
+    rng = random.Random(options.seed)
+
+    is_array = not isinstance(image, Image.Image)
+    img = Image.fromarray(image) if is_array else image
+
+    app = PixelSort()
+    app.options = options.to_options()
+    app.logger = logger
+
+    if app.options.en.value == "numpy":
+        from numpy_sorting import NumpySortingEngine
+        app.sorting_engine = NumpySortingEngine(app.options, rng, use_tables)
+    else:
+        app.sorting_engine = SortingEngine(app.options, rng)
+
+    if mask is not None:
+        mask = Image.fromarray(mask) if not isinstance(mask, Image.Image) else mask
+        app.options.m.value = "mask"
+        app.mask_image = ImageOps.invert(mask.convert("L"))
+
+    try:
+        rimg, sort_params = app.process_image(img.convert("RGB"), 0)
+    finally:
+        app.sorting_engine.close()
+
+    if is_array:
+        import numpy as np
+        return np.array(rimg)
+
+    return rimg
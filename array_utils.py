@@ -0,0 +1,66 @@
+import numpy as np
+
+# Vectorized versions of pixel_utils functions.
+# Every function takes (N, 3) uint8 array of pixels and returns (N,) uint8 array
+# with exactly the same values as pixel_utils would return for each pixel.
+
+def _hls(pixels):
+    """Return h, l, s float arrays, computed the same way as colorsys.rgb_to_hls."""
+    r = pixels[..., 0] / 255
+    g = pixels[..., 1] / 255
+    b = pixels[..., 2] / 255
+
+    maxc = np.maximum(np.maximum(r, g), b)
+    minc = np.minimum(np.minimum(r, g), b)
+    sumc = maxc+minc
+    rangec = maxc-minc
+    l = sumc/2.0
+
+    gray = minc == maxc
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = np.where(l <= 0.5, rangec/sumc, rangec/(2.0-maxc-minc))
+
+        rc = (maxc-r) / rangec
+        gc = (maxc-g) / rangec
+        bc = (maxc-b) / rangec
+
+    h = np.where(r == maxc, bc-gc, np.where(g == maxc, 2.0+rc-bc, 4.0+gc-rc))
+    h = np.mod(h/6.0, 1.0)
+
+    h[gray] = 0.0
+    s[gray] = 0.0
+
+    return h, l, s
+
+def hue(pixels):
+    """Return pixels hue."""
+    return (_hls(pixels)[0]*255).astype(np.uint8)
+
+def lightness(pixels):
+    """Return pixels lightness."""
+    return (_hls(pixels)[1]*255).astype(np.uint8)
+
+def saturation(pixels):
+    """Return pixels saturation."""
+    return (_hls(pixels)[2]*255).astype(np.uint8)
+
+def min_value(pixels):
+    """Return minimum value of pixels."""
+    return pixels.min(axis=-1)
+
+def max_value(pixels):
+    """Return maximum value of pixels."""
+    return pixels.max(axis=-1)
+
+def red(pixels):
+    """Return red color of pixels."""
+    return pixels[..., 0].copy()
+
+def green(pixels):
+    """Return green color of pixels."""
+    return pixels[..., 1].copy()
+
+def blue(pixels):
+    """Return blue color of pixels."""
+    return pixels[..., 2].copy()
@@ -0,0 +1,348 @@
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from pathlib import Path
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageOps
+import PIL
+
+from constants import *
+from metrics import peak_rss
+
+# Benchmark runner.
+# Every case is run in a fresh process, so peak RSS and caches of one case do not affect others.
+# Two stages are timed: "sort" is SortingEngine.sort_image of rotated image,
+# "process" is the whole PixelSort.process_image (resize, rotate, sort, rotate back,
+# crop, second pass and mask).
+# With --startup, whole main.py runs on small image are timed instead, including
+# interpreter start and imports.
+
+BENCHMARK_FLAGS = ["none", "sp", "de", "sm", "mask"]
+BENCHMARK_IMAGES = ["synthetic", "examples"]
+BENCHMARK_STAGES = ["sort", "process"]
+
+def parse_list(value: str, choices: list=None, val_type=str) -> list:
+    """
+    Parse comma separated list of values.
+
+    :param value: String like "0,45,90"
+    :type value: str
+    :param choices: Allowed values, if None, any value is allowed
+    :type choices: list
+    :param val_type: Type of values
+
+    :returns: List of values
+    :rtype: list
+    """
+    values = [val_type(part.strip()) for part in value.split(",") if part.strip()]
+
+    for val in values:
+        if choices is not None and val not in choices:
+            raise ValueError(f"{val!r} is not one of {', '.join(map(str, choices))}")
+
+    return values
+
+def image_size(megapixels: float, aspect: float) -> tuple:
+    """Return size of image with aspect ratio and number of megapixels."""
+    height = max(round(math.sqrt(megapixels*1e6/aspect)), 1)
+    return (max(round(height*aspect), 1), height)
+
+def synthetic_image(size: tuple) -> Image:
+    """
+    Create repeatable test image: gradients with smooth noise, so every segmentation
+    finds edges and runs of different lengths.
+    """
+    rng = random.Random(BENCHMARK_SEED)
+    noise = Image.frombytes("RGB", (64, 64), rng.randbytes(64*64*3)).resize(size, Image.BICUBIC)
+
+    linear = Image.linear_gradient("L")
+    gradient = Image.merge("RGB", (linear, Image.radial_gradient("L"), linear.rotate(90))).resize(size)
+
+    return Image.blend(noise, gradient, 0.5)
+
+def load_image(case: dict) -> Image:
+    """Create or load image of case."""
+    if case["image"] == "synthetic":
+        return synthetic_image(image_size(case["megapixels"], 4/3))
+
+    img = Image.open(BENCHMARK_EXAMPLE).convert("RGB")
+    return img.resize(image_size(case["megapixels"], img.size[0]/img.size[1]))
+
+def run_case(case: dict) -> dict:
+    """
+    Run one stage of one case, in worker process.
+
+    :param case: Case dict
+    :type case: dict
+
+    :returns: Dict with wall time, pixels per second and peak RSS
+    :rtype: dict
+    """
+    import api
+    from main import PixelSort
+
+    img = load_image(case)
+
+    options = api.SortOptions(segmentation=case["segmentation"], skey_choice=case["key"],
+                              angle=case["angle"], engine=case["engine"],
+                              second_pass=case["flag"] == "sp", decompose=case["flag"] == "de",
+                              symmetry=case["flag"] == "sm")
+
+    app = PixelSort()
+    app.options = options.to_options()
+    app.logger = logging.getLogger("pixelsort.benchmark")
+    app.sorting_engine = app.get_sorting_engine()
+
+    if case["flag"] == "mask":
+        app.options.m.value = "mask"
+        app.mask_image = ImageOps.invert(Image.radial_gradient("L").point(lambda v: 255 if v < 128 else 0))
+
+    try:
+        sort_params, sp_sort_params = app.calc_sort_params(0)
+
+        # lookup tables of numpy engine are built or loaded from disk by first sort,
+        # small image is sorted before timing, so cold cache does not look like regression
+        warmup = img.resize((16, 16))
+        app.sorting_engine.sort_image(sort_params=sort_params, image=warmup, og_image_size=warmup.size)
+        app.sorting_engine.random = random.Random(BENCHMARK_SEED)
+
+        if case["stage"] == "sort":
+            angle = 0 if app.options.rf.value else sort_params.a
+            rimg = img if app.options.rf.value else img.rotate(angle, expand=True)
+            mask = app.get_sort_mask(img.size, angle)
+
+            start_time = time.perf_counter()
+            app.sorting_engine.sort_image(sort_params=sort_params, image=rimg,
+                                          og_image_size=img.size, mask=mask)
+            wall_time = time.perf_counter()-start_time
+        else:
+            start_time = time.perf_counter()
+            app.process_image(img, 0)
+            wall_time = time.perf_counter()-start_time
+    finally:
+        app.sorting_engine.close()
+
+    pixels = img.size[0]*img.size[1]
+    return {"pixels": pixels, "wall_time": round(wall_time, 6),
+            "pixels_per_second": round(pixels/wall_time), "peak_rss": peak_rss()}
+
+def run_startup(name: str, args: list, repeat: int) -> dict:
+    """
+    Time command of startup benchmark, in new interpreter process.
+
+    :param name: Name of command
+    :type name: str
+    :param args: Arguments of main.py
+    :type args: list
+    :param repeat: Number of runs, the fastest run is recorded
+    :type repeat: int
+
+    :returns: Result dict with wall time
+    :rtype: dict
+    """
+    main_path = Path(__file__).with_name("main.py")
+    wall_time = None
+
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, str(main_path), *args], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        run_time = time.perf_counter()-start_time
+        wall_time = run_time if wall_time is None else min(wall_time, run_time)
+
+    return {"id": f"startup/{name}", "stage": "startup", "command": name,
+            "wall_time": round(wall_time, 6)}
+
+def run_startup_cases(engines: list, repeat: int, logger: logging.Logger) -> list:
+    """
+    Time help and whole runs of main.py on small image with every engine.
+
+    :param engines: List of engines
+    :type engines: list
+    :param repeat: Number of runs of every command
+    :type repeat: int
+    :param logger: Logger object
+    :type logger: logging.Logger
+
+    :returns: List of result dicts
+    :rtype: list
+    """
+    results = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        img_path = Path(folder) / "startup.png"
+        synthetic_image(image_size(BENCHMARK_STARTUP_MEGAPIXELS, 4/3)).save(img_path)
+
+        commands = [("help", ["-h"])]
+        commands += [(engine, [str(img_path), "-en", engine, "-o", str(Path(folder) / "output"), "--nl"])
+                     for engine in engines]
+
+        for name, args in commands:
+            result = run_startup(name, args, repeat)
+            results.append(result)
+            logger.info(f"{result['id']}: {result['wall_time']} s")
+
+    return results
+
+def run_cases(cases: list, repeat: int, logger: logging.Logger) -> list:
+    """
+    Run cases, every case in a fresh process, so peak RSS is measured per case.
+
+    :param cases: List of case dicts
+    :type cases: list
+    :param repeat: Number of runs of every case, the fastest run is recorded
+    :type repeat: int
+    :param logger: Logger object
+    :type logger: logging.Logger
+
+    :returns: List of result dicts
+    :rtype: list
+    """
+    logger.info(f"Running {len(cases)} cases...")
+
+    results = []
+    with get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        for n, case in enumerate(cases):
+            runs = [pool.apply(run_case, (case,)) for i in range(repeat)]
+            best = min(runs, key=lambda run: run["wall_time"])
+            rss = [run["peak_rss"] for run in runs if run["peak_rss"] is not None]
+            best["peak_rss"] = max(rss) if rss else None
+
+            result = {"id": case_id(case), **case, **best}
+            results.append(result)
+
+            logger.info(f"[{n+1}/{len(cases)}] {result['id']}: {result['wall_time']} s, "
+                        f"{result['pixels_per_second']} pixels/s")
+
+    return results
+
+def case_id(case: dict) -> str:
+    """Return string identifying case, used to match results with baseline."""
+    return "/".join(str(case[name]) for name in ("stage", "image", "megapixels", "engine",
+                                                  "segmentation", "key", "angle", "flag"))
+
+def compare(results: list, baseline: dict, threshold: float, logger: logging.Logger) -> int:
+    """
+    Compare results with baseline results.
+
+    :param results: List of result dicts
+    :type results: list
+    :param baseline: Baseline benchmark dict
+    :type baseline: dict
+    :param threshold: Relative slowdown counted as regression, 0.1 is 10%
+    :type threshold: float
+    :param logger: Logger object
+    :type logger: logging.Logger
+
+    :returns: Number of regressions
+    :rtype: int
+    """
+    baseline_times = {result["id"]: result["wall_time"] for result in baseline["results"]}
+
+    regressions = 0
+    improvements = 0
+    compared = 0
+
+    for result in results:
+        if result["id"] not in baseline_times:
+            continue
+
+        compared += 1
+        ratio = result["wall_time"]/baseline_times[result["id"]]
+
+        if ratio > 1+threshold:
+            regressions += 1
+            logger.warning(f"Regression {result['id']}: {baseline_times[result['id']]} -> {result['wall_time']} s ({ratio:.2f}x)")
+        elif ratio < 1-threshold:
+            improvements += 1
+            logger.info(f"Improvement {result['id']}: {baseline_times[result['id']]} -> {result['wall_time']} s ({ratio:.2f}x)")
+
+    logger.info(f"{compared} cases compared with baseline: {regressions} regressions, {improvements} improvements.")
+    return regressions
+
+def main() -> None:
+    """Parse arguments, run benchmark, save and compare results."""
+    arg_parser = ArgumentParser(description=HELP_BENCHMARK_DESCRIPTION)
+    arg_parser.add_argument("--engines", default=OPTION_DEFAULTS["engine"], help=HELP_BENCHMARK_ENGINES)
+    arg_parser.add_argument("--segmentations", default=",".join(SEGMENTATION_CHOICES), help=HELP_BENCHMARK_SEGMENTATIONS)
+    arg_parser.add_argument("--keys", default=",".join(SKEY_CHOICES), help=HELP_BENCHMARK_KEYS)
+    arg_parser.add_argument("--angles", default="0,45,90", help=HELP_BENCHMARK_ANGLES)
+    arg_parser.add_argument("--sizes", default="0.25", help=HELP_BENCHMARK_SIZES)
+    arg_parser.add_argument("--flags", default=",".join(BENCHMARK_FLAGS), help=HELP_BENCHMARK_FLAGS)
+    arg_parser.add_argument("--images", default="synthetic", help=HELP_BENCHMARK_IMAGES)
+    arg_parser.add_argument("--stages", default=",".join(BENCHMARK_STAGES), help=HELP_BENCHMARK_STAGES)
+    arg_parser.add_argument("--repeat", type=int, default=1, help=HELP_BENCHMARK_REPEAT)
+    arg_parser.add_argument("--output", default=BENCHMARK_OUTPUT, help=HELP_BENCHMARK_OUTPUT)
+    arg_parser.add_argument("--baseline", default=None, help=HELP_BENCHMARK_BASELINE)
+    arg_parser.add_argument("--threshold", type=float, default=BENCHMARK_THRESHOLD, help=HELP_BENCHMARK_THRESHOLD)
+    arg_parser.add_argument("--startup", action="store_true", help=HELP_BENCHMARK_STARTUP)
+    args = arg_parser.parse_args()
+
+    logger = logging.getLogger("pixelsort.benchmark")
+    logger.setLevel("INFO")
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_RECORD_FORMAT))
+    logger.addHandler(handler)
+
+    try:
+        matrix = {
+            "stage": parse_list(args.stages, BENCHMARK_STAGES),
+            "image": parse_list(args.images, BENCHMARK_IMAGES),
+            "megapixels": parse_list(args.sizes, None, float),
+            "engine": parse_list(args.engines, ENGINE_CHOICES),
+            "segmentation": parse_list(args.segmentations, SEGMENTATION_CHOICES),
+            "key": parse_list(args.keys, SKEY_CHOICES),
+            "angle": parse_list(args.angles, None, int),
+            "flag": parse_list(args.flags, BENCHMARK_FLAGS)
+        }
+    except ValueError as e:
+        arg_parser.error(str(e))
+
+    if args.startup:
+        results = run_startup_cases(matrix["engine"], args.repeat, logger)
+    else:
+        cases = [dict(zip(matrix.keys(), values)) for values in itertools.product(*matrix.values())]
+        results = run_cases(cases, args.repeat, logger)
+
+    benchmark = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": args.repeat
+        },
+        "results": results
+    }
+
+    try:
+        import numpy
+        benchmark["meta"]["numpy"] = numpy.__version__
+    except ImportError:
+        pass
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(benchmark, f, indent=2)
+    logger.info(f"Results saved to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if compare(results, baseline, args.threshold, logger):
+            exit(1)
+
+if __name__ == "__main__":
+    main()
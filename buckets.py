@@ -0,0 +1,109 @@
+import os
+import tempfile
+
+from constants import BUCKET_READ_SIZE
+
+class KeyBuckets(object):
+    """
+    256 buckets of pixels, one per 8-bit sorting key.
+    Pixels in every bucket keep the order they were added in, so reading buckets
+    in key order gives the same order as stable sort of all pixels by key.
+    Buckets are kept in memory until memory limit is reached, then they are
+    moved to temporary files.
+    """
+    def __init__(self, memory_limit: int):
+        """
+        :param memory_limit: Maximum size of buckets in memory in bytes
+        :type memory_limit: int
+        """
+        self.memory_limit = memory_limit
+        self.memory_size = 0
+
+        self.buckets = [bytearray() for i in range(256)]
+        self.files = [None]*256
+        self.folder = None
+
+    def add(self, buckets: list) -> None:
+        """
+        Append pixels to buckets.
+
+        :param buckets: List of 256 bytes objects with raw pixels of every key
+        :type buckets: list
+        """
+        for key, data in enumerate(buckets):
+            self.buckets[key] += data
+            self.memory_size += len(data)
+
+        if self.memory_size > self.memory_limit:
+            self.spill()
+
+    def spill(self) -> None:
+        """Append buckets in memory to their temporary files."""
+        if self.folder is None:
+            self.folder = tempfile.TemporaryDirectory(prefix="pixelsort_")
+
+        for key, data in enumerate(self.buckets):
+            if not data:
+                continue
+
+            if self.files[key] is None:
+                self.files[key] = open(os.path.join(self.folder.name, f"{key}.bin"), "w+b")
+
+            self.files[key].write(data)
+            self.buckets[key] = bytearray()
+
+        self.memory_size = 0
+
+    def read(self, descending: bool=False):
+        """
+        Yield contents of buckets in key order, in chunks.
+
+        :param descending: If True, buckets are read from key 255 to key 0
+        :type descending: bool
+        """
+        for key in (range(255, -1, -1) if descending else range(256)):
+            if self.files[key] is not None:
+                self.files[key].seek(0)
+
+                chunk = self.files[key].read(BUCKET_READ_SIZE)
+                while chunk:
+                    yield chunk
+                    chunk = self.files[key].read(BUCKET_READ_SIZE)
+
+            if self.buckets[key]:
+                yield bytes(self.buckets[key])
+
+    def read_rows(self, row_size: int, descending: bool=False):
+        """
+        Yield contents of buckets in key order, split to rows.
+
+        :param row_size: Size of row in bytes
+        :type row_size: int
+        :param descending: If True, buckets are read from key 255 to key 0
+        :type descending: bool
+        """
+        row = bytearray()
+
+        for chunk in self.read(descending):
+            row += chunk
+
+            while len(row) >= row_size:
+                yield bytes(row[:row_size])
+                del row[:row_size]
+
+        if row:
+            yield bytes(row)
+
+    def close(self) -> None:
+        """Close and remove temporary files."""
+        for file in self.files:
+            if file is not None:
+                file.close()
+
+        if self.folder is not None:
+            self.folder.cleanup()
+
+        self.buckets = [bytearray() for i in range(256)]
+        self.files = [None]*256
+        self.folder = None
+        self.memory_size = 0
@@ -1,33 +1,91 @@
 LOG_FOLDER = "logs"
 LOG_FORMAT = "pixelsort.log"
+LOG_RECORD_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+CACHE_FOLDER = "cache"
+LUT_FOLDER = f"{CACHE_FOLDER}/luts"
+LUT_VERSION = "v1"
+RESULT_CACHE_FOLDER = f"{CACHE_FOLDER}/results"
+RESULT_CACHE_VERSION = "v1"
+
+PIXEL_CACHE_SIZE = 1 << 18
+LINE_MAP_CACHE_SIZE = 8
+EDGE_MAP_CACHE_SIZE = 4
+# edge maps of smaller images calculate lightness of pixels one by one, importing numpy
+# and making full lightness table take longer than the map, bigger images use numpy
+EDGE_MAP_TABLE_PIXELS = 2**16
+SWEEP_CACHE_SIZE = 4
+BAND_MIN_PIXELS = 1 << 16
+FRAME_WINDOW = 2
+GIF_PALETTE_SAMPLE = 8
+GIF_QUEUE_SIZE = 4
+BUCKET_READ_SIZE = 1 << 20
+
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8765
+SERVE_STATS_SIZE = 1000
+# Host header values accepted by TCP server, other hosts may be DNS rebinding
+SERVE_LOCAL_HOSTS = ["localhost", "127.0.0.1", "::1"]
+WATCH_INTERVAL = 1.0
+
+BENCHMARK_SEED = 0
+BENCHMARK_EXAMPLE = "examples/img.jpg"
+BENCHMARK_OUTPUT = "benchmark.json"
+BENCHMARK_THRESHOLD = 0.1
+BENCHMARK_STARTUP_MEGAPIXELS = 0.01
+
+# options which change output and are not variable (variable ones are in SortParams)
+RESULT_KEY_OPTIONS = ["sg", "sk", "se", "ed", "sp", "re", "pr", "rf", "sm", "de", "sd", "pv"]
+
+# measured peak memory of sorting in bytes per pixel, by (engine, decompose flag)
+MEMORY_PER_PIXEL = {
+    ("python", False): 100, ("python", True): 230,
+    ("numpy", False): 100, ("numpy", True): 100
+}
 
 LOGLEVEL_CHOICES = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
 AUX_LL_CHOICES = list(map(str.lower, LOGLEVEL_CHOICES))
 SEGMENTATION_CHOICES = ["none", "row", "edge", "melting", "chunky", "blocky"]
+RANDOM_SEGMENTATIONS = ["melting", "chunky", "blocky"]
+MULTI_FRAME_EXTS = [".gif", ".raw", ".npy"]
+STRIP_SEGMENTATIONS = ["none", "row", "edge", "melting", "chunky", "blocky"]
+EDGE_DETECTOR_CHOICES = ["find_edges", "sobel"]
 SKEY_CHOICES = ["hue", "lightness", "saturation", "min_value", "max_value", "red", "green", "blue"]
+SKEY_EXPR_MAX_LENGTH = 1000
+# compiled source has parentheses for every level, Python allows 200 nested parentheses
+SKEY_EXPR_MAX_DEPTH = 100
+ENGINE_CHOICES = ["python", "numpy"]
+SORT_BACKEND_CHOICES = ["auto", "comparison", "counting"]
+METRICS_FORMAT_CHOICES = ["jsonl", "prometheus"]
 
 OPTION_DEFAULTS = {
-    "output": "pixelsorted", "mask": "", "loglevel": "INFO",
-    "segmentation": "edge", "skey_choice": "lightness", "ext": "same",
-    "threshold": 0.1, "offset": 0, "angle": 0, "sangle": 90,
+    "output": "pixelsorted", "mask": "", "raw_size": "", "loglevel": "INFO",
+    "segmentation": "edge", "skey_choice": "lightness", "skey_expr": "", "ext": "same",
+    "threshold": 0.1, "offset": 0, "edge_detector": "find_edges", "angle": 0, "sangle": 90,
     "size": 0.05, "randomness": 0, "length": 10, "scale": 1, "width": 0,
-    "height": 0, "amount": 1
+    "height": 0, "amount": 1, "engine": "python",
+    "sort_backend": "auto", "threads": 1, "jobs": 1,
+    "frame_jobs": 1, "max_memory": 0, "metrics": "", "metrics_format": "jsonl",
+    "profile": "", "seed": None, "result_cache": 0, "preview": 0
 }
 
 HELP_DESCRIPTION = "PixelSort is a python tool for sorting pixels in images."
 
-HELP_INPUT_PATH = "Input file path or folder."
-HELP_OUTPUT = f"Output file path or folder. Default is {OPTION_DEFAULTS['output']}."
+HELP_INPUT_PATH = "Input file path or folder, \"-\" reads raw rgb24 frames from stdin."
+HELP_OUTPUT = f"Output file path or folder, \"-\" writes raw rgb24 frames to stdout. Default is {OPTION_DEFAULTS['output']}."
 HELP_EXT = f"Output image extension. If output path specified this value will be ignored. Default is {OPTION_DEFAULTS['ext']}."
 HELP_MASK = f"Mask file path."
+HELP_RAW_SIZE = "Size of raw rgb24 frames read from stdin (input path \"-\") or .raw file, as WIDTHxHEIGHT or WIDTHxHEIGHTxFRAMES. If number of frames is not set, stdin has one frame and .raw file has as many frames as fit in it."
 
 HELP_LOGLEVEL = f"Log level for command line. Available choices: {', '.join(LOGLEVEL_CHOICES)} (lowercase is also accepted). Default is {OPTION_DEFAULTS['loglevel']}"
 
 HELP_SEGMENTATION = f"Segmentation. Available choices: {', '.join(SEGMENTATION_CHOICES)}. Default is {OPTION_DEFAULTS['segmentation']}."
 HELP_SKEY = f"Sorting key. Available choices: {', '.join(SKEY_CHOICES)}. Default is {OPTION_DEFAULTS['skey_choice']}."
+HELP_SKEY_EXPR = "Sorting key expression, used instead of sorting key. Names r, g, b, h, s, l are pixel values from 0 to 255, operators are + - * / %% ** and functions are abs, sqrt, cbrt, min and max. Result is clipped to 0-255. For example \"0.2126*r + 0.7152*g + 0.0722*b\"."
 
 HELP_THRESHOLD = f"Threshold for edge detection. Value should be between 0 and 1. Default is {OPTION_DEFAULTS['threshold']}."
 HELP_OFFSET = f"Offset for \"edge\" segmentation. Value should be an integer. Default is {OPTION_DEFAULTS['offset']}."
+HELP_EDGE_DETECTOR = f"Edge detector for \"edge\" segmentation. \"find_edges\" uses lightness of FIND_EDGES filter, \"sobel\" uses Sobel gradient magnitude of grayscale image. Available choices: {', '.join(EDGE_DETECTOR_CHOICES)}. Default is {OPTION_DEFAULTS['edge_detector']}."
 HELP_ANGLE = f"Angle to rotate the image before sorting in degrees. Value should be between 0 and 360. Default is {OPTION_DEFAULTS['angle']}."
 HELP_SANGLE = f"Angle for second pass. Value should be between 0 and 360. Default is {OPTION_DEFAULTS['sangle']}."
 HELP_SIZE = f"Size of \"melting\" or \"blocky\" segmentation. Value should be between 0.001 and 1. Default is {OPTION_DEFAULTS['size']}."
@@ -38,13 +96,58 @@ HELP_SCALE = f"Rescale image before sorting. If width or height are non-zero thi
 HELP_WIDTH = f"Resize to width before sorting. Value should be greater than or equal to 0. If value is zero, width is calculated automatically. Default is {OPTION_DEFAULTS['width']}."
 HELP_HEIGHT = f"Resize to height before sorting. Value should be greater than or equal to 0. If value is zero, height is calculated automatically. Default is {OPTION_DEFAULTS['height']}."
 
+HELP_ENGINE = f"Sorting engine. \"numpy\" engine requires NumPy and is much faster on big images. Available choices: {', '.join(ENGINE_CHOICES)}. Default is {OPTION_DEFAULTS['engine']}."
+HELP_SORT_BACKEND = f"Sorting algorithm of \"numpy\" engine. \"counting\" uses linear counting sort and needs 8 or 16-bit keys, \"comparison\" uses general stable sort, \"auto\" picks the faster one. Available choices: {', '.join(SORT_BACKEND_CHOICES)}. Default is {OPTION_DEFAULTS['sort_backend']}."
+HELP_THREADS = f"Number of threads sorting bands of one image with \"numpy\" engine. Value should be greater than or equal to 0. If value is zero, number of CPU cores is used. Default is {OPTION_DEFAULTS['threads']}."
+HELP_JOBS = f"Number of images processed in parallel when input is a folder. Value should be greater than or equal to 0. If value is zero, number of CPU cores is used. Default is {OPTION_DEFAULTS['jobs']}."
+HELP_FRAME_JOBS = f"Number of frames processed in parallel. Value should be greater than or equal to 0. If value is zero, number of CPU cores is used. Default is {OPTION_DEFAULTS['frame_jobs']}."
+
+HELP_MAX_MEMORY = f"Memory limit in megabytes. If image does not fit in it, image is sorted in horizontal strips and output is written strip by strip. Works at angle 0 or 180 without resizing, preview, second pass, mask and (with \"none\" segmentation) decompose flag, \"melting\", \"chunky\" and \"blocky\" segmentations work only at angle 0 without decompose flag. Input must be uncompressed, output must be PNG or PPM. Value should be greater than or equal to 0. If value is zero, there is no limit. Default is {OPTION_DEFAULTS['max_memory']}."
+
+HELP_METRICS = "Metrics file path. Duration and memory of every processing stage are written to it."
+HELP_METRICS_FORMAT = f"Format of metrics file. \"jsonl\" writes one JSON object per stage, \"prometheus\" writes Prometheus text with sums and counts of durations and peak memory, aggregated by stage. Available choices: {', '.join(METRICS_FORMAT_CHOICES)}. Default is {OPTION_DEFAULTS['metrics_format']}."
+HELP_PROFILE = "Profile file path. Run is profiled with cProfile and profile is saved to it, worker processes are not profiled."
+
+HELP_SEED = "Seed of random values of \"melting\", \"chunky\" and \"blocky\" segmentations. Output is the same every time, frames and images get their own random values, so output does not depend on number of jobs. If not set, output is random."
+HELP_RESULT_CACHE = f"Size of result cache in megabytes. Output images are stored in {RESULT_CACHE_FOLDER} folder by content of input and sorting parameters, sorting the same image with the same parameters again takes output from cache. Least recently used images are removed when cache is full. Images sorted with random segmentation are cached only with seed. Value should be greater than or equal to 0. If value is zero, cache is disabled. Default is {OPTION_DEFAULTS['result_cache']}."
+
+HELP_PREVIEW = f"Pixel budget of preview in megapixels. Image is sorted at lower resolution with at most this many pixels and saved with \"_preview\" suffix, length of \"chunky\" segmentation and offset are scaled with image. Value should be greater than or equal to 0. If value is zero, preview is disabled. Default is {OPTION_DEFAULTS['preview']}."
+
 HELP_AMOUNT = f"Amount of images. Value should be a natural value. If input is animated this value will be ignored. Default is {OPTION_DEFAULTS['amount']}."
 
 HELP_SECOND_PASS = "Do second pass."
 HELP_REVERSE = "Reverse sort."
 HELP_PRESERVE_RES = "Preserve resolution."
+HELP_ROTATION_FREE = "Sort along lines at the angle instead of rotating image, image is not resampled. Works only with \"numpy\" engine."
 HELP_SYMMETRY = "Make sort symmetrical."
 HELP_DECOMPOSE = "Decompose image to R, G and B channels and sort each separately."
+HELP_INCREMENTAL = "Sort frames of animation incrementally: rows which did not change since previous frame are taken from previous output. Random segment layout is the same in every frame. Frames are sorted one by one, frame jobs are not used."
+HELP_REFINE = "After preview is saved, sort images at full resolution in background process. Works only with preview and file input."
 
 HELP_SILENT = "Make app silent in command line."
 HELP_NOLOG = "Disable logging."
+
+HELP_SERVE_DESCRIPTION = "PixelSort server. Sorts jobs sent over HTTP and files put in drop folder with a pool of warm worker processes."
+HELP_SERVE_HOST = f"Host of HTTP server. Default is {SERVE_HOST}."
+HELP_SERVE_PORT = f"Port of HTTP server. If neither port nor socket is set, port {SERVE_PORT} is used."
+HELP_SERVE_SOCKET = "Unix domain socket path of HTTP server."
+HELP_SERVE_ROOT = "Folder which files of JSON jobs may be read from and written to, can be set several times. If no root is set, JSON jobs are refused."
+HELP_SERVE_WORKERS = "Number of worker processes. If value is zero, number of CPU cores is used. Default is 0."
+HELP_SERVE_WATCH = "Drop folder, new files put in it are sorted."
+HELP_SERVE_WATCH_OUTPUT = f"Output folder of files from drop folder, it should not be drop folder. Default is {OPTION_DEFAULTS['output']}."
+HELP_SERVE_WATCH_OPTIONS = "Options of files from drop folder as JSON object with long option names, for example '{\"segmentation\": \"chunky\"}'."
+
+HELP_BENCHMARK_DESCRIPTION = "PixelSort benchmark. Times every combination of listed values, lists are comma separated."
+HELP_BENCHMARK_ENGINES = f"Engines. Default is {OPTION_DEFAULTS['engine']}."
+HELP_BENCHMARK_SEGMENTATIONS = "Segmentations. Default is all segmentations."
+HELP_BENCHMARK_KEYS = "Sorting keys. Default is all sorting keys."
+HELP_BENCHMARK_ANGLES = "Angles. Default is 0,45,90."
+HELP_BENCHMARK_SIZES = "Image sizes in megapixels. Default is 0.25."
+HELP_BENCHMARK_FLAGS = "Flags: none, sp (second pass), de (decompose), sm (symmetry) and mask. Default is all flags."
+HELP_BENCHMARK_IMAGES = f"Images: synthetic (generated gradients with noise) and examples ({BENCHMARK_EXAMPLE}). Default is synthetic."
+HELP_BENCHMARK_STAGES = "Timed stages: sort (sorting engine only) and process (whole image processing). Default is both."
+HELP_BENCHMARK_REPEAT = "Number of runs of every case, the fastest run is recorded. Default is 1."
+HELP_BENCHMARK_OUTPUT = f"Output JSON file path. Default is {BENCHMARK_OUTPUT}."
+HELP_BENCHMARK_BASELINE = "Baseline JSON file path, results are compared with it and exit code is 1 if any case is slower than threshold."
+HELP_BENCHMARK_THRESHOLD = f"Relative slowdown counted as regression. Default is {BENCHMARK_THRESHOLD}."
+HELP_BENCHMARK_STARTUP = "Time startup of main.py instead: help and whole run on small image with every engine."
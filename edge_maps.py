@@ -0,0 +1,152 @@
+import colorsys
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from PIL import Image, ImageChops, ImageFilter
+
+from constants import EDGE_MAP_CACHE_SIZE, EDGE_MAP_TABLE_PIXELS
+
+# Edge maps are edge strength of every pixel in 0-255 range, as bytes in image row order.
+# They depend only on image content, so they are cached by content digest and
+# sorting the same image again with other threshold or offset does not filter it again.
+
+SOBEL_X = (-1, 0, 1, -2, 0, 2, -1, 0, 1)
+SOBEL_Y = (-1, -2, -1, 0, 0, 0, 1, 2, 1)
+
+_edge_maps = OrderedDict()
+_edge_maps_lock = threading.Lock()
+_lightness_table = None
+
+def find_edges(image: Image) -> bytes:
+    """Return lightness of image filtered with FIND_EDGES filter."""
+    edges = image.filter(ImageFilter.FIND_EDGES)
+    pixels = image.size[0]*image.size[1]
+
+    # importing numpy and making full lightness table take longer than small edge maps
+    np = None
+    if pixels >= EDGE_MAP_TABLE_PIXELS:
+        try:
+            import numpy as np
+        except ImportError:
+            pass
+
+    if np is None:
+        r, g, b = edges.split()
+
+        high = ImageChops.lighter(ImageChops.lighter(r, g), b).tobytes()
+        low = ImageChops.darker(ImageChops.darker(r, g), b).tobytes()
+
+        if pixels < EDGE_MAP_TABLE_PIXELS:
+            return bytes(map(pair_lightness, high, low))
+
+        # without numpy
+        table = get_lightness_table()
+        return bytes(table[(h << 8) | l] for h, l in zip(high, low))
+
+    table = get_lightness_table()
+    r, g, b = np.asarray(edges).reshape(-1, 3).T
+    high = np.maximum(np.maximum(r, g), b).astype(np.uint16)
+    low = np.minimum(np.minimum(r, g), b)
+
+    return np.frombuffer(table, dtype=np.uint8)[(high << 8) | low].tobytes()
+
+@lru_cache(maxsize=None)
+def pair_lightness(high: int, low: int) -> int:
+    """Return lightness of pixel with max value high and min value low."""
+    return int(colorsys.rgb_to_hls(high/255, low/255, low/255)[1]*255)
+
+def get_lightness_table() -> bytes:
+    """Return table of pixel lightness indexed by max value*256 + min value of pixel."""
+    global _lightness_table
+
+    if _lightness_table is None:
+        _lightness_table = bytes(
+            pair_lightness(high, low) if low <= high else 0
+            for high in range(256) for low in range(256)
+        )
+
+    return _lightness_table
+
+def sobel(image: Image) -> bytes:
+    """Return Sobel gradient magnitude |Gx|+|Gy| of image lightness, clipped to 255."""
+    gray = image.convert("L")
+
+    def gradient(kernel: tuple) -> Image:
+        # negative responses are clipped to 0, so absolute value needs both signs
+        positive = gray.filter(ImageFilter.Kernel((3, 3), kernel, scale=4))
+        negative = gray.filter(ImageFilter.Kernel((3, 3), [-k for k in kernel], scale=4))
+        return ImageChops.lighter(positive, negative)
+
+    return ImageChops.add(gradient(SOBEL_X), gradient(SOBEL_Y)).tobytes()
+
+def get_edge_map(image: Image, detector: str, input_key=None) -> bytes:
+    """
+    Calculate edge map of image. Results are cached.
+
+    :param image: RGB Image object
+    :type image: Image
+    :param detector: Name of edge detector function in this module
+    :type detector: str
+    :param input_key: Hashable key of image content, if None, content digest is used
+
+    :returns: Edge strength of every pixel
+    :rtype: bytes
+    """
+    if input_key is None:
+        input_key = hashlib.blake2b(image.tobytes(), digest_size=16).digest()
+
+    key = (detector, image.size, input_key)
+
+    with _edge_maps_lock:
+        if key in _edge_maps:
+            _edge_maps.move_to_end(key)
+            return _edge_maps[key]
+
+    edge_map = globals()[detector](image)
+
+    with _edge_maps_lock:
+        _edge_maps[key] = edge_map
+        if len(_edge_maps) > EDGE_MAP_CACHE_SIZE:
+            _edge_maps.popitem(last=False)
+
+    return edge_map
+
+def row_boundaries(edge_row: bytes, t: float, of: int) -> list:
+    """
+    Find segment boundaries of one row. Pixel x is a boundary if edge strength
+    of pixel x-of is greater than t*255, last pixel is always a boundary.
+    Negative indices wrap around like in lists, indices past the row are clipped.
+
+    :param edge_row: Edge strength of row pixels
+    :type edge_row: bytes
+    :param t: Threshold
+    :type t: float
+    :param of: Offset
+    :type of: int
+
+    :returns: List of boundary positions in ascending order
+    :rtype: list
+    """
+    length = len(edge_row)
+    if length == 0:
+        return []
+
+    # threshold whole row at once with translation table
+    mask = edge_row.translate(bytes(int(v > t*255) for v in range(256)))
+
+    if of > 0:
+        mask = mask[:1]*max(of-length, 0) + mask[-of:] + mask[:-of]
+        mask = mask[:length]
+    elif of < 0:
+        mask = mask[-of:] + mask[-1:]*min(-of, length)
+
+    boundaries = []
+    x = mask.find(1, 0, length-1)
+    while x != -1:
+        boundaries.append(x)
+        x = mask.find(1, x+1, length-1)
+    boundaries.append(length-1)
+
+    return boundaries
@@ -0,0 +1,163 @@
+import queue
+import struct
+import threading
+from pathlib import Path
+
+from PIL import GifImagePlugin, Image
+
+from constants import GIF_PALETTE_SAMPLE, GIF_QUEUE_SIZE
+
+class GifWriter(object):
+    """
+    Animated GIF writer which encodes frames as they come.
+    Every frame is mapped to one global palette, so colors do not flicker between frames.
+    Frames are quantized and encoded in a separate thread, while next frames are processed.
+    """
+    def __init__(self, file_path: Path, palette: list=None, duration: int=None, loop: int=0):
+        """
+        :param file_path: Output file path
+        :type file_path: Path
+        :param palette: Global palette as list of RGB values. If None, palette is
+                        calculated from first GIF_PALETTE_SAMPLE frames.
+        :type palette: list
+        :param duration: Duration of every frame in milliseconds
+        :type duration: int
+        :param loop: Number of loops, 0 means forever
+        :type loop: int
+        """
+        self.file_path = file_path
+        self.duration = duration
+        self.loop = loop
+
+        self.palette_image = None
+        if palette is not None:
+            self.set_palette(palette)
+
+        self.file = None
+        self.sample = []
+
+        self.queue = queue.Queue(maxsize=GIF_QUEUE_SIZE)
+        self.error = None
+        self.aborted = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def set_palette(self, palette: list) -> None:
+        """Set global palette."""
+        palette = list(palette)[:768]
+        self.palette_image = Image.new("P", (1, 1))
+        self.palette_image.putpalette(palette + [0]*(768-len(palette)))
+
+    def write(self, img: Image) -> None:
+        """
+        Add frame to the end of animation. Blocks if encoder is too far behind.
+
+        :param img: RGB Image object
+        :type img: Image
+        """
+        if self.error is not None:
+            raise self.error
+
+        self.queue.put(img)
+
+    def close(self) -> None:
+        """Encode remaining frames and close file."""
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def abort(self) -> None:
+        """Stop writer thread without encoding remaining frames and delete partial file."""
+        self.aborted = True
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.file is not None:
+            self.file.close()
+
+        try:
+            Path(self.file_path).unlink()
+        except OSError: # file was not created yet
+            pass
+
+    def run(self) -> None:
+        """Encode frames from queue, runs in writer thread."""
+        done = False
+
+        try:
+            while not done:
+                img = self.queue.get()
+                done = img is None
+
+                if done:
+                    break
+
+                # frames are taken until None, so abort never waits for full queue
+                if self.aborted:
+                    continue
+
+                if self.palette_image is None:
+                    self.sample.append(img)
+                    if len(self.sample) >= GIF_PALETTE_SAMPLE:
+                        self.flush_sample()
+                    continue
+
+                self.encode(img)
+
+            if self.aborted:
+                return
+
+            if self.sample:
+                self.flush_sample()
+
+            if self.file is not None:
+                self.file.write(b";") # trailer
+                self.file.close()
+        except Exception as e:
+            self.error = e
+            if self.file is not None:
+                self.file.close()
+
+            # unblock write calls until close is called
+            while not done:
+                done = self.queue.get() is None
+
+    def flush_sample(self) -> None:
+        """Calculate palette from sampled frames and encode them."""
+        width = max(img.size[0] for img in self.sample)
+        montage = Image.new("RGB", (width, sum(img.size[1] for img in self.sample)))
+
+        y = 0
+        for img in self.sample:
+            montage.paste(img, (0, y))
+            y += img.size[1]
+
+        self.set_palette(montage.quantize(256).getpalette())
+
+        for img in self.sample:
+            self.encode(img)
+        self.sample = []
+
+    def encode(self, img: Image) -> None:
+        """Quantize frame to global palette and write it."""
+        if self.file is None:
+            self.write_header(img.size)
+
+        frame = img.convert("RGB").quantize(palette=self.palette_image, dither=Image.Dither.NONE)
+
+        params = {"duration": self.duration} if self.duration else {}
+        for data in GifImagePlugin.getdata(frame, **params):
+            self.file.write(data)
+
+    def write_header(self, size: tuple) -> None:
+        """Open file and write header with global palette and loop extension."""
+        self.file = open(self.file_path, "wb")
+
+        self.file.write(b"GIF89a" + struct.pack("<HH", *size))
+        # global color table of 256 colors, background color 0
+        self.file.write(bytes([0xF7, 0, 0]))
+        self.file.write(bytes(self.palette_image.getpalette()[:768]))
+
+        self.file.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\x00")
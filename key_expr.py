@@ -0,0 +1,256 @@
+import ast
+import colorsys
+import hashlib
+import math
+from functools import lru_cache
+
+from constants import PIXEL_CACHE_SIZE, SKEY_EXPR_MAX_DEPTH, SKEY_EXPR_MAX_LENGTH
+
+# Sorting key expressions, like "0.2126*r + 0.7152*g + 0.0722*b".
+# Expression is parsed once and checked against small grammar: numbers, names of
+# pixel values, arithmetic operators and few functions. Checked tree is turned to
+# Python source, which is compiled twice: with float helpers for python engine
+# (one pixel at a time) and with numpy helpers for numpy engine (whole image at once).
+# Both give the same keys: r, g, b are 0-255, h, s, l are 0-255 floats computed like
+# colorsys, result is clipped to 0-255 and truncated, NaN is 0. Result is rounded to
+# ROUND_SCALE steps before truncation, so last bit differences of vectorized math
+# functions do not change keys.
+
+ROUND_SCALE = 10**9
+
+NAMES = ["r", "g", "b", "h", "s", "l"]
+HLS_NAMES = ["h", "l", "s"]
+FUNCTIONS = {"abs": 1, "sqrt": 1, "cbrt": 1, "min": None, "max": None}
+
+BINARY_OPERATORS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*"}
+# operators which raise errors on Python floats are called as helpers
+BINARY_HELPERS = {ast.Div: "_div", ast.Mod: "_mod", ast.Pow: "_pow"}
+UNARY_OPERATORS = {ast.UAdd: "+", ast.USub: "-"}
+
+class KeyExpression(object):
+    """Parsed and checked sorting key expression."""
+    def __init__(self, text: str):
+        """
+        :param text: Expression text
+        :type text: str
+
+        :raises ValueError: If expression is invalid
+        """
+        if len(text) > SKEY_EXPR_MAX_LENGTH:
+            raise ValueError(f"expression is longer than {SKEY_EXPR_MAX_LENGTH} characters")
+
+        try:
+            tree = ast.parse(text.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError(e.msg) from None
+        except (ValueError, RecursionError, MemoryError):
+            raise ValueError("expression can not be parsed") from None
+
+        self.text = text.strip()
+        self.names = set()
+        self.source = self.to_source(tree.body)
+        # same key for the same expression written with other spacing
+        self.normalized = ast.dump(tree)
+
+        # compiled here, so expressions which can not be compiled fail when they are checked
+        try:
+            self.code = compile(self.source, "<skey_expr>", "eval")
+        except (SyntaxError, RecursionError, MemoryError):
+            raise ValueError("expression can not be compiled") from None
+
+    def to_source(self, node, depth: int=0) -> str:
+        """
+        Check node and return Python source of it.
+
+        :param depth: Nesting depth of node
+
+        :raises ValueError: If node is not allowed or nested too deeply
+        """
+        if depth > SKEY_EXPR_MAX_DEPTH:
+            raise ValueError(f"expression is nested deeper than {SKEY_EXPR_MAX_DEPTH} levels")
+
+        if isinstance(node, ast.Constant):
+            if type(node.value) not in (int, float):
+                raise ValueError(f"{node.value!r} is not a number")
+
+            try:
+                value = float(node.value)
+            except OverflowError:
+                value = math.inf
+            if not math.isfinite(value):
+                raise ValueError(f"{ast.get_source_segment(self.text, node)} is too large")
+
+            return repr(value)
+
+        if isinstance(node, ast.Name):
+            if node.id not in NAMES:
+                raise ValueError(f"unknown name {node.id!r}, names are {', '.join(NAMES)}")
+            self.names.add(node.id)
+            return node.id
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            return f"({self.to_source(node.left, depth+1)} {BINARY_OPERATORS[type(node.op)]} {self.to_source(node.right, depth+1)})"
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_HELPERS:
+            return f"{BINARY_HELPERS[type(node.op)]}({self.to_source(node.left, depth+1)}, {self.to_source(node.right, depth+1)})"
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            return f"({UNARY_OPERATORS[type(node.op)]}{self.to_source(node.operand, depth+1)})"
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+                raise ValueError(f"unknown function, functions are {', '.join(FUNCTIONS)}")
+            if node.keywords:
+                raise ValueError(f"{node.func.id} does not take keyword arguments")
+
+            arg_count = FUNCTIONS[node.func.id]
+            if arg_count is not None and len(node.args) != arg_count:
+                raise ValueError(f"{node.func.id} takes {arg_count} argument")
+            if arg_count is None and len(node.args) < 2:
+                raise ValueError(f"{node.func.id} takes at least 2 arguments")
+
+            return f"_{node.func.id}({', '.join(self.to_source(arg, depth+1) for arg in node.args)})"
+
+        if isinstance(node, ast.expr):
+            raise ValueError(f"{ast.get_source_segment(self.text, node)!r} is not allowed")
+        raise ValueError("expression is not allowed")
+
+    @property
+    def table_name(self) -> str:
+        """Name of 24-bit lookup table of expression."""
+        return f"expr_{hashlib.blake2b(self.normalized.encode(), digest_size=8).hexdigest()}"
+
+    @property
+    def uses_hls(self) -> bool:
+        """True if expression uses hue, saturation or lightness, which are expensive to compute."""
+        return not self.names.isdisjoint(HLS_NAMES)
+
+@lru_cache(maxsize=16)
+def parse(text: str) -> KeyExpression:
+    """
+    Parse and check expression, parsed expressions are cached.
+
+    :param text: Expression text
+    :type text: str
+
+    :returns: KeyExpression object
+    :rtype: KeyExpression
+
+    :raises ValueError: If expression is invalid
+    """
+    return KeyExpression(text)
+
+# helpers of python engine, they return inf and NaN like numpy instead of raising errors
+
+def _div(a, b):
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a == 0 or a != a:
+            return math.nan
+        return math.copysign(math.inf, a)*math.copysign(1.0, b)
+
+def _mod(a, b):
+    try:
+        return a % b
+    except ZeroDivisionError:
+        return math.nan
+
+def _pow(a, b):
+    try:
+        return math.pow(a, b)
+    except OverflowError:
+        return -math.inf if a < 0 and b % 2 == 1 else math.inf
+    except ValueError: # zero to negative power or negative to fractional power
+        if a != 0:
+            return math.nan
+        return math.copysign(math.inf, a) if b % 2 == 1 else math.inf
+
+def _sqrt(x):
+    return math.sqrt(x) if x >= 0 or x != x else math.nan
+
+def _cbrt(x):
+    return math.copysign(math.pow(abs(x), 1/3), x)
+
+def _min(*args):
+    return math.nan if any(arg != arg for arg in args) else min(args)
+
+def _max(*args):
+    return math.nan if any(arg != arg for arg in args) else max(args)
+
+PYTHON_HELPERS = {"_div": _div, "_mod": _mod, "_pow": _pow, "_abs": abs,
+                  "_sqrt": _sqrt, "_cbrt": _cbrt, "_min": _min, "_max": _max}
+
+@lru_cache(maxsize=16)
+def python_key(text: str):
+    """
+    Return sorting key function of python engine, it takes pixel tuple and returns int.
+    Keys are cached like pixel_utils functions.
+
+    :param text: Expression text
+    :type text: str
+
+    :raises ValueError: If expression is invalid
+    """
+    expression = parse(text)
+    code = expression.code
+    namespace = {"__builtins__": {}, **PYTHON_HELPERS}
+    uses_hls = expression.uses_hls
+
+    @lru_cache(maxsize=PIXEL_CACHE_SIZE)
+    def skey(pixel):
+        values = {"r": float(pixel[0]), "g": float(pixel[1]), "b": float(pixel[2])}
+        if uses_hls:
+            h, l, s = colorsys.rgb_to_hls(*[i/255 for i in pixel])
+            values.update(h=h*255, l=l*255, s=s*255)
+
+        value = eval(code, namespace, values)
+        if value != value:
+            return 0
+        return math.floor(min(max(value, 0.0), 255.0)*ROUND_SCALE + 0.5) // ROUND_SCALE
+
+    return skey
+
+@lru_cache(maxsize=16)
+def array_key(text: str):
+    """
+    Return sorting key function of numpy engine, it takes (N, 3) uint8 array of pixels
+    and returns (N,) uint8 array.
+
+    :param text: Expression text
+    :type text: str
+
+    :raises ValueError: If expression is invalid
+    """
+    import numpy as np
+
+    import array_utils
+
+    expression = parse(text)
+    code = expression.code
+
+    def min_values(*args):
+        return np.minimum.reduce(np.broadcast_arrays(*args))
+
+    def max_values(*args):
+        return np.maximum.reduce(np.broadcast_arrays(*args))
+
+    namespace = {"__builtins__": {}, "_div": np.divide, "_mod": np.mod, "_pow": np.power,
+                 "_abs": np.abs, "_sqrt": np.sqrt,
+                 "_cbrt": lambda x: np.copysign(np.power(np.abs(x), 1/3), x),
+                 "_min": min_values, "_max": max_values}
+
+    def skey(pixels):
+        values = {name: pixels[..., i].astype(np.float64) for i, name in enumerate("rgb")}
+        if expression.uses_hls:
+            h, l, s = array_utils._hls(pixels)
+            values.update(h=h*255, l=l*255, s=s*255)
+
+        with np.errstate(all="ignore"):
+            keys = np.asarray(eval(code, namespace, values), dtype=np.float64)
+
+        keys = np.floor(np.clip(np.nan_to_num(keys, nan=0.0), 0.0, 255.0)*ROUND_SCALE + 0.5)
+        keys = (keys.astype(np.int64) // ROUND_SCALE).astype(np.uint8)
+        return np.broadcast_to(keys, pixels.shape[:-1]).copy()
+
+    return skey
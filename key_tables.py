@@ -0,0 +1,91 @@
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+import array_utils
+from constants import *
+
+# Sorting keys which are expensive to compute and are looked up in 24-bit tables.
+# Each table has an uint8 key for every possible RGB color, indexed by (r<<16)|(g<<8)|b.
+TABLE_KEYS = ["hue", "lightness", "saturation"]
+
+_tables = {}
+# tables are built once, even if several threads need them at the same time
+_tables_lock = threading.Lock()
+
+def pack(pixels):
+    """Return (N,) uint32 array with table indices of (N, 3) uint8 array of pixels."""
+    pixels = pixels.astype(np.uint32)
+    return (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+
+def table_path(name: str) -> Path:
+    """Return path of table file."""
+    return Path(LUT_FOLDER) / f"{name}_{LUT_VERSION}.npy"
+
+def build_table(name: str, path: Path, skey=None) -> None:
+    """
+    Build table and save it to path.
+    Table is written to temporary file first, so parallel processes never see partial table.
+
+    :param name: Name of sorting key
+    :type name: str
+    :param path: Table file path
+    :type path: Path
+    :param skey: Vectorized sorting key function, if None, array_utils function of name is used
+    """
+    os.makedirs(path.parent, exist_ok=True)
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npy")
+
+    table = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(1 << 24,))
+    skey = skey or getattr(array_utils, name)
+
+    # one red value at a time, to keep memory usage low
+    gb = np.arange(1 << 16, dtype=np.uint32)
+    pixels = np.empty((1 << 16, 3), dtype=np.uint8)
+    pixels[:, 1] = gb >> 8
+    pixels[:, 2] = gb & 255
+
+    for red in range(256):
+        pixels[:, 0] = red
+        table[red << 16:(red+1) << 16] = skey(pixels)
+
+    table.flush()
+    del table
+
+    os.replace(tmp_path, path)
+
+def get_table(name: str, skey=None):
+    """
+    Return read-only memory-mapped table for sorting key, build it if needed.
+
+    :param name: Name of sorting key
+    :type name: str
+    :param skey: Vectorized sorting key function, if None, array_utils function of name is used
+
+    :returns: (2^24,) uint8 array
+    """
+    with _tables_lock:
+        if name not in _tables:
+            path = table_path(name)
+
+            if not path.is_file():
+                build_table(name, path, skey)
+
+            _tables[name] = np.load(path, mmap_mode="r")
+
+        return _tables[name]
+
+def lookup(name: str, pixels, skey=None):
+    """
+    Return sorting keys of pixels.
+
+    :param name: Name of sorting key
+    :type name: str
+    :param pixels: (N, 3) uint8 array
+    :param skey: Vectorized sorting key function, if None, array_utils function of name is used
+
+    :returns: (N,) uint8 array
+    """
+    return get_table(name, skey)[pack(pixels)]
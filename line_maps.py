@@ -0,0 +1,75 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+
+from constants import LINE_MAP_CACHE_SIZE
+
+class LineMap(object):
+    """
+    Scan lines of image at some angle.
+    Lines are digital (DDA) lines, every pixel of image belongs to exactly one line.
+    Lines go in the same direction and order as rows of image rotated by angle.
+    """
+    def __init__(self, order, starts, lengths, rstarts):
+        # flat pixel indices, grouped by lines, ordered by position within line
+        self.order = order
+        # start index and length of every line in order array
+        self.starts = starts
+        self.lengths = lengths
+        # position of first pixel of every line along the line direction
+        self.rstarts = rstarts
+
+    def rows(self) -> list:
+        """
+        Return rows in the same format as NumpySortingEngine.calc_rows.
+
+        :returns: List of tuples with relative left bound, relative right bound,
+                  start index and length of line.
+        :rtype: list
+        """
+        return list(zip(self.rstarts.tolist(), (self.rstarts+self.lengths).tolist(),
+                        self.starts.tolist(), self.lengths.tolist()))
+
+@lru_cache(maxsize=LINE_MAP_CACHE_SIZE)
+def get_line_map(width: int, height: int, angle: int) -> LineMap:
+    """
+    Calculate scan lines of image at angle. Results are cached.
+
+    :param width: Image width
+    :type width: int
+    :param height: Image height
+    :type height: int
+    :param angle: Angle in degrees, counter clockwise like in Image.rotate
+    :type angle: int
+
+    :returns: LineMap object
+    :rtype: LineMap
+    """
+    cos = math.cos(math.radians(angle))
+    sin = math.sin(math.radians(angle))
+
+    # image row (left to right) of image rotated by angle goes along (cos, sin)
+    # in original image and rows follow each other along (-sin, cos)
+    ys, xs = np.divmod(np.arange(width*height, dtype=np.int64), width)
+
+    if abs(cos) >= abs(sin): # one pixel per column
+        lines = ys - np.floor(xs*(sin/cos) + 0.5).astype(np.int64)
+        positions = xs if cos > 0 else width-1-xs
+        lines = lines if cos > 0 else -lines
+    else:                    # one pixel per row
+        lines = xs - np.floor(ys*(cos/sin) + 0.5).astype(np.int64)
+        positions = ys if sin > 0 else height-1-ys
+        lines = -lines if sin > 0 else lines
+
+    order = np.lexsort((positions, lines))
+
+    lines = lines[order]
+    starts = np.flatnonzero(np.diff(lines, prepend=lines[0]-1))
+    lengths = np.diff(starts, append=order.size)
+    rstarts = positions[order[starts]]
+
+    for array in (order, starts, lengths, rstarts):
+        array.flags.writeable = False
+
+    return LineMap(order, starts, lengths, rstarts)
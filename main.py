@@ -1,18 +1,32 @@
 from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import copy
+import functools
+import hashlib
+import itertools
 import logging
-import logging.handlers
+import math
 import os
+import random
+import sys
 import time
 from pathlib import Path
 
-from PIL import Image, ImageFilter, ImageOps
+from PIL import Image
 
 from constants import *
+from metrics import Metrics
 import pixel_utils
+import raw_io
 from utils import SortParams
 from options import Option, Options
 from sorting import SortingEngine
 
+# Modules which are needed only by some options (worker pools, strips, GIF writer,
+# result cache, mask) are imported where they are used, so short runs on small
+# images do not pay for importing them.
+
 class PixelSort:
     """Pixelsort app class."""
     def __init__(self):
@@ -21,13 +35,41 @@ class PixelSort:
         self.file_handler = None
         
         self.options = Options()
-        self.supported_exts = list(Image.registered_extensions().keys())
+        self._supported_exts = None
         self.img_count = 0
+        self.amount = 1
         self.sorting_engine = None
+        self.metrics = Metrics()
         self.img_path = ""
         self.img_size = (0, 0)
 
         self.mask_image = None
+        self.mask_digest = None
+        self.result_cache = None
+        self.resized_masks = {}
+        self.sort_masks = {}
+        # size of decoded image relative to its real size, see draft_preview
+        self.draft_factor = 1
+
+        # intermediates of the same input image, see sweep_intermediate
+        self.sweep_source = None
+        self.sweep_token = None
+        self.sweep_cache = OrderedDict()
+
+        # inputs and outputs of previous frame by sort pass, see sort_frame
+        self.incremental_frames = {}
+        self.incremental_seed = None
+
+    @property
+    def supported_exts(self) -> list:
+        """
+        List of supported image extensions. Listing extensions loads every Pillow plugin,
+        so it is done only when folder is scanned or output extension is checked.
+        """
+        if self._supported_exts is None:
+            self._supported_exts = list(Image.registered_extensions().keys()) + raw_io.RAW_EXTS
+
+        return self._supported_exts
 
     def main(self) -> None:
         """Do main work."""
@@ -37,65 +79,587 @@ class PixelSort:
         img_filenames = self.get_image_filenames()
 
         self.img_count = len(img_filenames)
+        self.logger.debug(f"Found {self.img_count} images.")
+
+        start_time = time.monotonic()
+
+        # records of worker processes are written to the same file
+        metrics = Metrics(self.options.mt.value, self.options.mf.value)
+        metrics.reset()
+
+        profiler = None
+        if self.options.pf.value:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        jobs = min(self.options.j.value or os.cpu_count(), self.img_count)
+
+        try:
+            if jobs > 1:
+                results = self.process_files_parallel(img_filenames, jobs)
+            else:
+                self.prepare()
+                results = [self.run_file(img_path) for img_path in img_filenames]
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.options.pf.value)
+                self.logger.info(f"Profile saved to {self.options.pf.value}")
+
+            metrics.finish()
+
+        self.log_summary(results, round(time.monotonic()-start_time, 3))
+
+        if self.options.rn.value:
+            self.refine_in_background()
+
+        if any(error is not None for img_path, elapsed_time, error in results):
+            exit(1)
+
+    def refine_in_background(self) -> None:
+        """Run the same command without preview in detached process, which saves full resolution images."""
+        if raw_io.is_stdio(self.options.input_path.value):
+            self.logger.warning("Input from stdin can not be read again, refining is skipped.")
+            return
+
+        # last value of argument wins, so preview is disabled
+        args = [sys.executable, sys.argv[0], *sys.argv[1:], "-pv", "0"]
+
+        import subprocess
+
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, start_new_session=True)
+        self.logger.info(f"Refining to full resolution in background process {process.pid}...")
+
+    def prepare(self) -> None:
+        """Create sorting engine and open mask image."""
+        self.amount = self.options.am.value
 
         self.logger.debug("Initializing SortingEngine object...")
-        self.sorting_engine = SortingEngine(self.options)
+        self.sorting_engine = self.get_sorting_engine()
+
+        self.metrics = Metrics(self.options.mt.value, self.options.mf.value,
+                               {"engine": self.options.en.value, "segmentation": self.options.sg.value,
+                                "key": self.options.sk.value if not self.options.se.value else "expr"})
+        self.sorting_engine.metrics = self.metrics
 
         if self.options.m.value != "":
+            from PIL import ImageOps
+
             self.logger.info(f"Opening mask image...")
             self.mask_image = ImageOps.invert(
                 Image.open(self.options.m.value).convert("L")
             )
 
-        for img_number in range(self.img_count):
-            start_time = time.monotonic()
+        if self.options.rc.value > 0:
+            from result_cache import ResultCache, digest
+
+            self.result_cache = ResultCache(RESULT_CACHE_FOLDER, self.options.rc.value*2**20)
+
+            if self.mask_image is not None:
+                self.mask_digest = digest(self.mask_image.size, self.mask_image.tobytes())
+
+    @contextmanager
+    def worker_pool(self, jobs: int):
+        """
+        Create pool of worker processes with copies of this app.
+        Workers send log records to this process, so only this process writes log file.
+
+        :param jobs: Number of worker processes
+        :type jobs: int
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        import logging.handlers
+        import multiprocessing
+
+        log_queue = multiprocessing.Queue()
+        listener = logging.handlers.QueueListener(log_queue, *self.logger.handlers,
+                                                  respect_handler_level=True)
+        listener.start()
+
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                     initargs=(self.options, self.img_count, log_queue)) as executor:
+                yield executor
+        finally:
+            listener.stop()
+
+    def process_files_parallel(self, img_filenames: list, jobs: int) -> list:
+        """
+        Process images in a pool of worker processes.
+
+        :param img_filenames: List of image filenames
+        :type img_filenames: list
+        :param jobs: Number of worker processes
+        :type jobs: int
+
+        :returns: List of tuples returned by run_file, in the same order as filenames
+        :rtype: list
+        """
+        self.logger.info(f"Processing {self.img_count} images with {jobs} workers...")
+
+        with self.worker_pool(jobs) as executor:
+            futures = [executor.submit(run_worker_file, img_path) for img_path in img_filenames]
+
+            results = []
+            for img_path, future in zip(img_filenames, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e: # worker process died
+                    self.logger.error(f"Failed to process {img_path.name}: {e!r}")
+                    results.append((img_path, 0, repr(e)))
+
+        return results
+
+    def run_file(self, img_path: Path) -> tuple:
+        """
+        Process image file and catch any error, so one bad file does not stop processing.
+
+        :param img_path: Image file path
+        :type img_path: Path
 
-            self.img_path = img_filenames[img_number]
-            self.logger.debug(f"Found {self.img_count} images.")
-            self.logger.info(f"Opening image {self.img_path.name}...")
+        :returns: Tuple of image path, elapsed time and error message (None if there is no error)
+        :rtype: tuple
+        """
+        start_time = time.monotonic()
+        self.metrics.labels["file"] = img_path.name or "stdin"
+
+        try:
+            with self.metrics.stage("file"):
+                self.process_file(img_path)
+        except Exception as e:
+            self.logger.error(f"Failed to process {img_path.name}: {e!r}")
+            self.logger.debug("Traceback:", exc_info=True)
+            return (img_path, round(time.monotonic()-start_time, 3), repr(e))
+
+        elapsed_time = round(time.monotonic()-start_time, 3)
+        self.logger.info(f"{img_path.name} done in {elapsed_time} seconds.")
+
+        return (img_path, elapsed_time, None)
+
+    def process_file(self, img_path: Path) -> None:
+        """
+        Sort every frame of image file and save output.
+        Frames are decoded, sorted and saved one by one, so only a few frames are in memory.
+
+        :param img_path: Image file path
+        :type img_path: Path
+        """
+        self.img_path = img_path
+        self.options.am.value = self.amount
+
+        self.logger.info(f"Opening image {self.img_path.name or 'from stdin'}...")
+        if raw_io.is_raw_path(self.img_path):
+            img = raw_io.RawImage(self.img_path, self.options.rs.value)
+        else:
             img = Image.open(self.img_path)
 
-            images = []
+        # set amount to n_frames, if n_frames > 1
+        if getattr(img, "n_frames", 1) > 1:
+            self.options.am.value = img.n_frames
+
+        # frames of previous file are not compared with frames of this one
+        self.incremental_frames.clear()
+        self.incremental_seed = random.getrandbits(64)
+
+        self.draft_preview(img)
+
+        if self.use_strips(img):
+            self.process_strips(img)
+            return
+
+        results = self.process_frames(self.read_frames(img))
+
+        if raw_io.is_stdio(self.options.o.value) or self.get_save_ext() in raw_io.RAW_EXTS:
+            self.save_raw(results)
+        elif self.get_out_ext() == ".gif" and self.options.am.value > 1:
+            self.save_animation(results, self.get_input_palette(img), img.info.get("duration"))
+        elif self.get_out_ext() == ".gif":
+            i, rimg, sort_params = next(results)
+            self.save_file(sort_params, 1, [rimg])
+        else:
+            for i, rimg, sort_params in results:
+                self.save_file(sort_params, i+1, [rimg])
+
+    def get_input_palette(self, img: Image) -> list:
+        """
+        Return palette of input image, if it can be global palette of output: every frame
+        has only colors of the first frame's palette and options only move pixels, without
+        resampling or mixing them. Frames are decoded once more to check their colors.
+
+        :param img: Image object
+        :type img: Image
+
+        :returns: Palette as list of RGB values, or None if palette is calculated from output
+        :rtype: list
+        """
+        if img.mode != "P":
+            return None
+
+        angles = [self.options.a.keyframes]
+        if self.options.sp.value:
+            angles.append(self.options.sa.keyframes)
+
+        # resizing, filled corners of rotation, blended mask and decomposed
+        # channels make colors which are not in palette
+        if (self.options.sc.keyframes != (1, 1)
+            or self.options.w.keyframes != (0, 0)
+            or self.options.hg.keyframes != (0, 0)
+            or self.options.pv.value
+            or self.options.pr.value
+            or self.options.m.value != ""
+            or self.options.de.value
+            or (not self.options.rf.value
+                and any(start != end or start % 90 != 0 for start, end in angles))):
+            return None
+
+        palette = img.getpalette()
+        palette_colors = {tuple(palette[i:i+3]) for i in range(0, len(palette), 3)}
+
+        try:
+            for i in range(getattr(img, "n_frames", 1)):
+                img.seek(i)
+                colors = img.convert("RGB").getcolors(len(palette_colors))
+                # frame has local palette with other colors
+                if colors is None or not palette_colors.issuperset(color for count, color in colors):
+                    self.logger.debug("Frames have different palettes, palette is calculated from output.")
+                    return None
+        finally:
+            img.seek(0)
+
+        return palette
+
+    def estimate_memory(self, img_size: tuple, sort_params: SortParams) -> int:
+        """
+        Estimate peak memory of sorting image in memory.
 
-            # append every frame to images list
-            for i in range(1, getattr(img, "n_frames", 1)+1):
-                img.seek(i-1)
-                self.logger.debug(f"Converting frame {i} to RGB...")
-                images.append(img.convert("RGB"))
+        :param img_size: Input image size
+        :type img_size: tuple
+        :param sort_params: SortParams object
+        :type sort_params: SortParams
 
-            sort_params = SortParams()
-            # set amount to n_frames, if n_frames > 1
-            if getattr(img, "n_frames", 1) > 1:
-                self.options.am.value = img.n_frames
+        :returns: Estimated peak memory in bytes
+        :rtype: int
+        """
+        self.img_size = img_size
+        width, height = self.calc_dims(sort_params)
 
-            # duplicate references to the same object.
-            if len(images) < self.options.am.value:
-                images = [images[0] for i in range(self.options.am.value)]
+        if not self.options.rf.value: # size of image rotated with expand=True
+            cos = abs(math.cos(math.radians(sort_params.a)))
+            sin = abs(math.sin(math.radians(sort_params.a)))
+            width, height = width*cos+height*sin, width*sin+height*cos
 
-            # sort every frame
-            for i in range(self.options.am.value):
+        per_pixel = MEMORY_PER_PIXEL[(self.options.en.value, self.options.de.value)]
+
+        # decoded input image is 4 bytes per pixel
+        return round(img_size[0]*img_size[1]*4 + width*height*per_pixel)
+
+    def use_strips(self, img: Image) -> bool:
+        """
+        Check if image does not fit in memory limit and should be processed in strips.
+
+        :param img: Image object
+        :type img: Image
+
+        :returns: True if image should be processed in strips
+        :rtype: bool
+        """
+        # preview is sorted at lower resolution with scaled parameters, which strips do not do
+        if self.options.mm.value == 0 or self.options.am.value > 1 or self.options.pv.value:
+            return False
+
+        sort_params, sp_sort_params = self.calc_sort_params(0)
+        memory = self.estimate_memory(img.size, sort_params)
+        if self.options.sp.value:
+            memory = max(memory, self.estimate_memory(img.size, sp_sort_params))
+
+        self.logger.debug(f"Estimated peak memory is {memory/2**20:.0f} MB.")
+
+        if memory <= self.options.mm.value*2**20:
+            return False
+
+        import strips
+
+        # random values and state of chunky and blocky segmentations are taken row by row,
+        # strips of rotated or decomposed image would take them in other order than whole image
+        random_order = (self.options.sg.value in RANDOM_SEGMENTATIONS
+                        and (sort_params.a % 360 == 180 or self.options.de.value))
+
+        if (self.options.sg.value not in STRIP_SEGMENTATIONS
+            or self.options.sg.value == "none" and self.options.de.value
+            or random_order
+            or sort_params.a % 180 != 0
+            or self.options.sp.value
+            or self.calc_dims(sort_params) != img.size
+            or self.options.m.value != ""
+            or raw_io.is_raw_path(self.img_path)
+            or raw_io.is_stdio(self.options.o.value)
+            or self.get_save_ext().lower() not in strips.STRIP_WRITER_EXTS):
+            self.logger.warning("Image does not fit in memory limit, but strip mode does not "
+                                "support selected options, sorting in memory...")
+            return False
+
+        # compressed image would be decoded whole anyway
+        if not strips.StripReader(self.img_path).streamable:
+            self.logger.warning(f"Image does not fit in memory limit, but {self.img_path.name} "
+                                "can not be decoded partially, sorting in memory...")
+            return False
+
+        return True
+
+    def process_strips(self, img: Image) -> None:
+        """
+        Sort image in horizontal strips, so whole image is never in memory.
+
+        :param img: Image object
+        :type img: Image
+        """
+        sort_params, sp_sort_params = self.calc_sort_params(0)
+        width, height = img.size
+        self.seed_random(0)
+
+        from strips import StripReader, get_strip_writer
+
+        reader = StripReader(self.img_path)
+
+        budget = self.options.mm.value*2**20
+        per_pixel = MEMORY_PER_PIXEL[(self.options.en.value, self.options.de.value)]
+        rows = max(budget // (width*per_pixel), 1)
+
+        file_path = Path(self.generate_file_path(sort_params, 1))
+        os.makedirs(file_path.parent, exist_ok=True)
+
+        self.logger.info(f"Sorting in strips of {rows} rows, saving to {file_path}...")
+        writer = get_strip_writer(file_path, img.size)
+
+        try:
+            if self.options.sg.value == "none":
+                self.sort_strips_globally(reader, writer, sort_params, rows,
+                                          budget-rows*width*per_pixel)
+            else:
+                self.sort_strips(reader, writer, sort_params, rows)
+
+            writer.close()
+        finally:
+            reader.close()
+            writer.abort()
+
+        self.logger.info("Saved.")
+
+    def sort_strips(self, reader: "StripReader", writer: "StripWriter",
+                    sort_params: SortParams, rows: int) -> None:
+        """
+        Sort every strip separately.
+
+        :param reader: StripReader object of input image
+        :type reader: StripReader
+        :param writer: StripWriter object of output image
+        :type writer: StripWriter
+        :param sort_params: SortParams object
+        :type sort_params: SortParams
+        :param rows: Number of rows in strip
+        :type rows: int
+        """
+        width, height = reader.size
+        # edge detection needs neighbour rows of strip
+        halo = 1 if self.options.sg.value == "edge" else 0
+
+        for y0 in range(0, height, rows):
+            y1 = min(y0+rows, height)
+            top = max(y0-halo, 0)
+            bottom = min(y1+halo, height)
+
+            self.logger.debug(f"Sorting rows {y0}-{y1}...")
+            strip = reader.read(top, bottom)
+
+            if sort_params.a % 360 == 180:
+                strip = strip.rotate(180)
+                first_row = height-bottom
+            else:
+                first_row = top
+
+            self.sorting_engine.sort_image(sort_params=sort_params, image=strip,
+                                           og_image_size=reader.size,
+                                           first_row=first_row, continued=y0 > 0)
+
+            if sort_params.a % 360 == 180:
+                strip = strip.rotate(180)
+
+            writer.write(strip.crop((0, y0-top, width, y1-top)))
+
+    def sort_strips_globally(self, reader: "StripReader", writer: "StripWriter",
+                             sort_params: SortParams, rows: int, memory_limit: int) -> None:
+        """
+        Sort all pixels of image together (none segmentation).
+        Pixels of every strip are split to 256 buckets by sorting key, reading buckets
+        in key order gives the same order as stable sort, then rows are filled in order.
+        Buckets which do not fit in memory limit are kept in temporary files.
+
+        :param reader: StripReader object of input image
+        :type reader: StripReader
+        :param writer: StripWriter object of output image
+        :type writer: StripWriter
+        :param sort_params: SortParams object
+        :type sort_params: SortParams
+        :param rows: Number of rows in strip
+        :type rows: int
+        :param memory_limit: Memory limit of buckets in bytes
+        :type memory_limit: int
+        """
+        width, height = reader.size
+        from buckets import KeyBuckets
+
+        buckets = KeyBuckets(max(memory_limit, 0))
+
+        # image rotated by 180 degrees is the same as reversed image, so filling rows
+        # of unrotated image in order takes buckets in opposite order and reverses rows
+        rotated = sort_params.a % 360 == 180
+        descending = self.options.re.value != rotated
+
+        try:
+            for y0 in range(0, height, rows):
+                self.logger.debug(f"Splitting rows {y0}-{min(y0+rows, height)} to buckets...")
+                buckets.add(self.sorting_engine.bucket_pixels(reader.read(y0, min(y0+rows, height))))
+
+            self.logger.debug("Filling rows...")
+            strip = []
+            for row in buckets.read_rows(width*3, descending):
+                if self.options.sm.value:
+                    pixels = [row[x:x+3] for x in range(0, len(row), 3)]
+
+                    pixels = pixels[::-1] if rotated else pixels
+                    pixels = pixels[::2] + pixels[1::2][::-1]
+                    pixels = pixels[::-1] if rotated else pixels
+
+                    row = b"".join(pixels)
+
+                strip.append(row)
+
+                if len(strip) == rows:
+                    writer.write(Image.frombytes("RGB", (width, rows), b"".join(strip)))
+                    strip = []
+
+            if strip:
+                writer.write(Image.frombytes("RGB", (width, len(strip)), b"".join(strip)))
+        finally:
+            buckets.close()
+
+    def read_frames(self, img: Image):
+        """
+        Yield every frame of image converted to RGB.
+        If image has one frame, it is yielded amount times.
+
+        :param img: Image object
+        :type img: Image
+        """
+        if getattr(img, "n_frames", 1) > 1:
+            for i in range(img.n_frames):
+                img.seek(i)
+                self.logger.debug(f"Converting frame {i+1} to RGB...")
+                yield img.convert("RGB")
+            return
+
+        self.logger.debug(f"Converting image to RGB...")
+        frame = img.convert("RGB")
+
+        # yield references to the same object
+        for i in range(self.options.am.value):
+            yield frame
+
+    def process_frames(self, frames):
+        """
+        Process frames and yield results in order.
+        If frame jobs option is greater than one, frames are processed in worker processes,
+        no more than FRAME_WINDOW frames per worker are in progress at the same time.
+
+        :param frames: Iterable with frames
+
+        :returns: Generator of tuples with frame number, output image and SortParams object
+        """
+        jobs = self.options.fj.value or os.cpu_count()
+
+        # incremental mode compares every frame with previous one, frames are sorted in order
+        if self.incremental and jobs > 1:
+            self.logger.debug("Frames are sorted incrementally, frame jobs are not used.")
+            jobs = 1
+
+        if jobs < 2 or self.options.am.value < 2:
+            for i, frame in enumerate(frames):
                 self.logger.info(f"Preparing frame {i+1}/{self.options.am.value}...")
+                yield (i, *self.process_image(frame, i))
+            return
 
-                rimg, sort_params = self.process_image(images[i], i)
+        with self.worker_pool(jobs) as executor:
+            pending = deque()
 
-                if self.get_out_ext() == ".gif":
-                    images[i] = rimg.copy() # we will save it later
-                else:
-                    self.save_file(sort_params, i+1, [rimg])
+            for i, frame in enumerate(frames):
+                self.logger.info(f"Preparing frame {i+1}/{self.options.am.value}...")
+                pending.append((i, executor.submit(run_worker_frame, frame, i)))
+
+                if len(pending) >= jobs*FRAME_WINDOW:
+                    i, future = pending.popleft()
+                    yield (i, *future.result())
+
+            while pending:
+                i, future = pending.popleft()
+                yield (i, *future.result())
 
-            if self.get_out_ext() == ".gif":
-                self.save_file(sort_params, 1, images)
+    def log_summary(self, results: list, elapsed_time: float) -> None:
+        """
+        Log timing summary and list of failed files.
 
-            elapsed_time = round(time.monotonic()-start_time, 3)
+        :param results: List of tuples returned by run_file
+        :type results: list
+        :param elapsed_time: Wall time of the whole run
+        :type elapsed_time: float
+        """
+        failed = [(img_path, error) for img_path, file_time, error in results if error is not None]
+        done_times = [file_time for img_path, file_time, error in results if error is None]
 
+        if len(results) > 1:
             self.logger.info(
-                f"{self.img_path.name} done in {elapsed_time} seconds.")
+                f"{len(done_times)}/{len(results)} images done in {elapsed_time} seconds "
+                f"({round(sum(done_times), 3)} seconds of processing, "
+                f"{round(sum(done_times)/max(len(done_times), 1), 3)} seconds per image).")
+
+        if failed:
+            self.logger.error(f"{len(failed)} images failed:")
+            for img_path, error in failed:
+                self.logger.error(f"  {img_path}: {error}")
+
+    def get_sorting_engine(self) -> SortingEngine:
+        """
+        Create sorting engine selected in options.
+
+        :returns: Sorting engine object
+        :rtype: SortingEngine
+        """
+        if self.options.en.value == "numpy":
+            try:
+                from numpy_sorting import NumpySortingEngine
+            except ImportError:
+                self.logger.critical("NumPy is not installed, exiting...")
+                exit(1)
+
+            return NumpySortingEngine(self.options)
+
+        return SortingEngine(self.options)
 
     def setup_logging(self) -> None:
-        """Setup logging."""
+        """Setup logging to stream. File logging is set up after parsing arguments."""
         self.logger = logging.getLogger("pixelsort")
         self.logger.setLevel("DEBUG")
 
+        self.stream_handler = logging.StreamHandler()
+        self.stream_handler.setFormatter(logging.Formatter(LOG_RECORD_FORMAT))
+
+        self.logger.addHandler(self.stream_handler)
+
+    def setup_file_logging(self) -> None:
+        """Setup logging to file, log folder is created only if logs are written."""
+        import logging.handlers
+
         os.makedirs(LOG_FOLDER, exist_ok=True)
 
         self.file_handler = logging.handlers.RotatingFileHandler(
@@ -103,16 +667,9 @@ class PixelSort:
                                 maxBytes=100000, backupCount=3,
                                 delay=True
                             )
-        self.stream_handler = logging.StreamHandler()
-
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        )
-        self.file_handler.setFormatter(formatter)
-        self.stream_handler.setFormatter(formatter)
+        self.file_handler.setFormatter(logging.Formatter(LOG_RECORD_FORMAT))
 
         self.logger.addHandler(self.file_handler)
-        self.logger.addHandler(self.stream_handler)
 
     def setup_argparser(self):
         arg_parser = ArgumentParser(description=HELP_DESCRIPTION)
@@ -130,10 +687,7 @@ class PixelSort:
             elif option.option_type == 1:
                 arg_parser.add_argument(f"-{option.short}",
                     f"--{option.name.replace('_', '-')}",
-                    choices=(
-                        option.choices if option.name != "ext"
-                        else self.supported_exts+["same"]
-                    ),
+                    choices=option.choices,
                     type=str if option.isvariable else option.val_type,
                     help=option.help_string, metavar="",
                     dest=option.short, default=option.default)
@@ -145,6 +699,11 @@ class PixelSort:
         arg_parser = self.setup_argparser()
         args = arg_parser.parse_args()
 
+        # extension is checked here instead of by choices, so plugins are loaded only if it is set
+        if args.e != "same" and args.e not in self.supported_exts:
+            arg_parser.error(f"argument -e/--ext: invalid choice: {args.e!r} "
+                             f"(choose from {', '.join(map(repr, self.supported_exts+['same']))})")
+
         # apply args to options object
         for option in self.options.__dict__.values():
             setattr(option, "value", args.__dict__[option.short])
@@ -153,12 +712,22 @@ class PixelSort:
         self.stream_handler.setLevel(self.options.ll.value.upper())
         if self.options.sl.value or self.options.nl.value:
             self.logger.removeHandler(self.stream_handler)
-        if self.options.nl.value:
-            self.logger.removeHandler(self.file_handler)
+        if not self.options.nl.value:
+            self.setup_file_logging()
+
+        # expression is parsed once here, so invalid expression fails before any image is read
+        if self.options.se.value:
+            import key_expr
+
+            try:
+                key_expr.parse(self.options.se.value)
+            except ValueError as e:
+                arg_parser.error(f"argument -se/--skey-expr: {e}")
 
         # set values to default if these values will not be used
         if self.options.sg.value != "edge":
             self.options.t.set_to_default()
+            self.options.ed.set_to_default()
 
         if not self.options.sp.value:
             self.options.sa.set_to_default()
@@ -172,6 +741,14 @@ class PixelSort:
         if self.options.sg.value != "chunky":
             self.options.l.set_to_default()
 
+        if self.options.en.value != "numpy":
+            self.options.sb.set_to_default()
+            self.options.rf.set_to_default()
+            self.options.th.set_to_default()
+
+        if not self.options.pv.value:
+            self.options.rn.set_to_default()
+
         if (str(self.options.w.value) != "0"
             or str(self.options.hg.value) != "0"):
             self.options.sc.set_to_default()
@@ -235,16 +812,14 @@ class PixelSort:
 
         return (new_width, new_height)
 
-    def process_image(self, img: Image, i: int) -> tuple:
+    def calc_sort_params(self, i: int) -> tuple:
         """
-        Process image.
+        Calculate parameters of first and second pass.
 
-        :param img: Image object.
-        :type img: Image
         :param i: Number of image.
         :type i: int
 
-        :returns: Tuple of output image and SortParams object.
+        :returns: Tuple of SortParams objects of first and second pass.
         :rtype: tuple
         """
         sort_params = SortParams()
@@ -262,56 +837,416 @@ class PixelSort:
 
         sp_sort_params.a = sort_params.a+sort_params.sa
 
+        return (sort_params, sp_sort_params)
+
+    def process_image(self, img: Image, i: int) -> tuple:
+        """
+        Process image.
+
+        :param img: Image object.
+        :type img: Image
+        :param i: Number of image.
+        :type i: int
+
+        :returns: Tuple of output image and SortParams object.
+        :rtype: tuple
+        """
+        sort_params, sp_sort_params = self.calc_sort_params(i)
+        self.metrics.labels["frame"] = i
+        self.seed_random(i)
+
+        cache_key = self.result_cache_key(img, i, sort_params, sp_sort_params)
+        if cache_key is not None:
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                self.logger.info("Sorted image is taken from result cache.")
+                return (cached, sort_params)
+
         # resize
         self.img_size = img.size
         new_dims = self.calc_dims(sort_params)
+
+        # output is named by requested parameters, not by scaled ones
+        out_sort_params = sort_params
+        if self.options.pv.value:
+            new_dims, sort_params, sp_sort_params = self.calc_preview(new_dims, sort_params, sp_sort_params)
+
         self.logger.debug(f"Resizing image to {new_dims[0]}x{new_dims[1]}...")
-        rimg = img.resize(new_dims)
+        with self.metrics.stage("resize"):
+            rimg = self.sweep_intermediate(img, ("resize", new_dims), lambda: img.resize(new_dims))
         self.img_size = new_dims
 
-        # rotate
-        self.logger.debug(f"Rotating image by {sort_params.a} degrees...")
-        rimg = rimg.rotate(sort_params.a, expand=True)
+        # rotate, rotation free sorting works with unrotated image
+        if not self.options.rf.value:
+            self.logger.debug(f"Rotating image by {sort_params.a} degrees...")
+            with self.metrics.stage("rotate", sort_pass=1):
+                rimg = self.sweep_intermediate(img, ("rotate", new_dims, sort_params.a),
+                                               lambda: rimg.rotate(sort_params.a, expand=True))
+
+        # sorting changes image, intermediates are kept for next frames
+        rimg = rimg.copy()
+        input_key = (self.sweep_token, new_dims, sort_params.a, self.options.rf.value) if self.options.am.value > 1 else None
+        mask = self.get_sort_mask(new_dims, sort_params.a if not self.options.rf.value else 0)
 
         # first pass sorting
         self.logger.info("Sorting image...")
-        self.sorting_engine.sort_image(sort_params=sort_params,
-                                       image=rimg,
-                                       og_image_size=self.img_size)
+        with self.metrics.stage("sort_image", sort_pass=1):
+            self.sort_frame(1, rimg, sort_params, mask, input_key)
         self.logger.debug("First pass sorting done." if self.options.sp.value else "Sorting done.")
 
         # rotate back
-        self.logger.debug(f"Rotating image by {-sort_params.a} degrees...")
-        rimg = rimg.rotate(-sort_params.a, expand=True)
-        rimg = rimg.crop(self.get_crop_rectangle(rimg.size))
+        if not self.options.rf.value:
+            self.logger.debug(f"Rotating image by {-sort_params.a} degrees...")
+            with self.metrics.stage("rotate_back", sort_pass=1):
+                rimg = rimg.rotate(-sort_params.a, expand=True)
+            with self.metrics.stage("crop", sort_pass=1):
+                rimg = rimg.crop(self.get_crop_rectangle(rimg.size))
 
         if self.options.sp.value:
             self.logger.info("Second pass preparing...")
+            mask = self.get_sort_mask(rimg.size, sp_sort_params.a if not self.options.rf.value else 0)
 
             # rotate
-            self.logger.debug(f"Rotating image by {sp_sort_params.a} degrees...")
-            rimg = rimg.rotate(sp_sort_params.a, expand=True)
-            
+            if not self.options.rf.value:
+                self.logger.debug(f"Rotating image by {sp_sort_params.a} degrees...")
+                with self.metrics.stage("rotate", sort_pass=2):
+                    rimg = rimg.rotate(sp_sort_params.a, expand=True)
+
             # second pass sorting
             self.logger.info("Second pass sorting...")
-            self.sorting_engine.sort_image(sort_params=sp_sort_params,
-                                           image=rimg,
-                                           og_image_size=self.img_size)
+            with self.metrics.stage("sort_image", sort_pass=2):
+                self.sort_frame(2, rimg, sp_sort_params, mask)
             self.logger.debug("Second pass sorting done.")
 
             # rotate back
-            self.logger.debug(f"Rotating image by {-sp_sort_params.a} degrees...")
-            rimg = rimg.rotate(-sp_sort_params.a, expand=True)
-            rimg = rimg.crop(self.get_crop_rectangle(rimg.size))
-
-        if self.options.pr.value: # preserve resolution
+            if not self.options.rf.value:
+                self.logger.debug(f"Rotating image by {-sp_sort_params.a} degrees...")
+                with self.metrics.stage("rotate_back", sort_pass=2):
+                    rimg = rimg.rotate(-sp_sort_params.a, expand=True)
+                with self.metrics.stage("crop", sort_pass=2):
+                    rimg = rimg.crop(self.get_crop_rectangle(rimg.size))
+
+        if self.options.pr.value and not self.options.pv.value: # preserve resolution
             self.logger.debug(f"Resizing image back to {img.size}")
-            rimg = rimg.resize(img.size)
+            with self.metrics.stage("preserve_res"):
+                rimg = rimg.resize(img.size)
 
+        # masked pixels are not sorted, pasting restores them exactly after rotation
+        # and resizing, and blends soft edges of mask
         if self.options.m.value != "":
-            rimg.paste(img.resize(rimg.size), None, self.mask_image.resize(rimg.size))
+            with self.metrics.stage("mask"):
+                size = rimg.size
+                rimg.paste(self.sweep_intermediate(img, ("resize", size), lambda: img.resize(size)),
+                           None, self.get_resized_mask(size))
+
+        if cache_key is not None:
+            self.result_cache.put(cache_key, rimg)
+
+        return (rimg, out_sort_params)
+
+    @property
+    def incremental(self) -> bool:
+        """True if frames are sorted incrementally, see sort_frame."""
+        return self.options.ic.value and self.options.am.value > 1
+
+    def sort_frame(self, sort_pass: int, image: Image, sort_params: SortParams,
+                   mask: Image, input_key=None) -> None:
+        """
+        Sort image in place. In incremental mode image is compared with image of the same
+        pass of previous frame. If parameters did not change, only rows which changed are
+        sorted and other rows are taken from output of previous frame. Random segment layout
+        is the same in every frame (see seed_random), so output is the same as if whole
+        image was sorted.
+
+        :param sort_pass: Number of sort pass, 1 or 2
+        :type sort_pass: int
+        :param image: Rotated image
+        :type image: Image
+        :param sort_params: SortParams object of pass
+        :type sort_params: SortParams
+        :param mask: Mask of sortable pixels or None, see get_sort_mask
+        :type mask: Image
+        :param input_key: Key of image content, see SortingEngine.sort_image
+        """
+        runs = None
+        if self.incremental:
+            state_key = (image.size, self.img_size, sorted(vars(sort_params).items()))
+            previous = self.incremental_frames.get(sort_pass)
+            source = image.copy()
+
+            # "none" segmentation sorts all pixels together and rotation free sorting
+            # sorts along lines, so there are no rows to sort separately
+            if (previous is not None and previous[0] == state_key
+                and self.options.sg.value != "none" and not self.options.rf.value):
+                with self.metrics.stage("diff", sort_pass=sort_pass):
+                    runs = self.changed_rows(previous[1], image)
+
+                changed = sum(end-start for start, end in runs)
+                self.logger.debug(f"{changed}/{image.height} rows changed since previous frame.")
+                # whole image is sorted without mask of rows
+                if changed == image.height:
+                    runs = None
+
+        if runs is not None:
+            from PIL import ImageChops
+
+            rows_mask = Image.new("L", image.size, 0)
+            for start, end in runs:
+                rows_mask.paste(1, (0, start, image.width, end))
+            mask = rows_mask if mask is None else ImageChops.darker(mask, rows_mask)
+
+        if runs is None or runs:
+            self.sorting_engine.sort_image(sort_params=sort_params,
+                                           image=image,
+                                           og_image_size=self.img_size,
+                                           input_key=input_key,
+                                           mask=mask)
+
+        if runs is not None:
+            # unchanged rows have the same input and layout, so the same output
+            output = previous[2]
+            y = 0
+            for start, end in runs + [(image.height, image.height)]:
+                if start > y:
+                    image.paste(output.crop((0, y, image.width, start)), (0, y))
+                y = end
+
+        if self.incremental:
+            self.incremental_frames[sort_pass] = (state_key, source, image.copy())
+
+    def changed_rows(self, previous: Image, image: Image) -> list:
+        """
+        Find rows which differ between images of the same size. Edges are found with 3x3
+        filters, so with "edge" segmentation neighbouring rows are changed too.
+
+        :param previous: Image of previous frame
+        :type previous: Image
+        :param image: Image of current frame
+        :type image: Image
+
+        :returns: List of (start, end) tuples of changed rows
+        :rtype: list
+        """
+        from PIL import ImageChops
+
+        diff = ImageChops.difference(previous, image)
+        bbox = diff.getbbox()
+        if bbox is None:
+            return []
+
+        # pixel changed if any channel changed
+        diff = diff.crop((0, bbox[1], image.width, bbox[3]))
+        diff = functools.reduce(ImageChops.lighter, diff.split())
+
+        data = diff.tobytes()
+        width = image.width
+        unchanged_row = bytes(width)
+        margin = 1 if self.options.sg.value == "edge" else 0
+
+        runs = []
+        for y in range(bbox[3]-bbox[1]):
+            if data[y*width:(y+1)*width] == unchanged_row:
+                continue
+
+            start = max(bbox[1]+y-margin, 0)
+            end = min(bbox[1]+y+1+margin, image.height)
+            if runs and start <= runs[-1][1]:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((start, end))
+
+        return runs
+
+    def calc_preview(self, dims: tuple, sort_params: SortParams, sp_sort_params: SortParams) -> tuple:
+        """
+        Scale dimensions down to preview pixel budget. Parameters in pixels (length and offset)
+        are scaled too, parameters relative to image size already scale with it.
+
+        :param dims: Dimensions of image
+        :type dims: tuple
+        :param sort_params: SortParams object of first pass
+        :type sort_params: SortParams
+        :param sp_sort_params: SortParams object of second pass
+        :type sp_sort_params: SortParams
+
+        :returns: Tuple of dimensions and scaled SortParams objects of first and second pass
+        :rtype: tuple
+        """
+        factor = min(math.sqrt(self.options.pv.value*1e6/(dims[0]*dims[1])), 1)
+        # image decoded at lower resolution is already scaled
+        params_factor = factor*self.draft_factor
+
+        if factor < 1:
+            dims = (max(int(dims[0]*factor), 1), max(int(dims[1]*factor), 1))
+            self.logger.debug(f"Preview size is {dims[0]}x{dims[1]}.")
+
+        if params_factor >= 1:
+            return (dims, sort_params, sp_sort_params)
+
+        scaled = []
+        for params in (sort_params, sp_sort_params):
+            params = copy.copy(params)
+            params.l = max(params.l*params_factor, 1)
+            params.of = round(params.of*params_factor)
+            scaled.append(params)
+
+        return (dims, *scaled)
+
+    def draft_preview(self, img: Image) -> None:
+        """
+        Decode JPEG image at lower resolution which is still bigger than preview,
+        it is much faster than decoding whole image. Only done when image is not resized
+        by options, because scale, width and height are relative to real size.
+
+        :param img: Image object, not loaded yet
+        :type img: Image
+        """
+        self.draft_factor = 1
+
+        if (not self.options.pv.value
+            or getattr(img, "format", None) != "JPEG"
+            or self.options.sc.keyframes != (1, 1)
+            or self.options.w.keyframes != (0, 0)
+            or self.options.hg.keyframes != (0, 0)):
+            return
+
+        width, height = img.size
+        factor = math.sqrt(self.options.pv.value*1e6/(width*height))
+        if factor >= 1:
+            return
+
+        # draft picks the smallest scale which is not smaller than requested size
+        img.draft("RGB", (math.ceil(width*factor), math.ceil(height*factor)))
+        self.draft_factor = img.size[0]/width
+        self.logger.debug(f"Decoding image at {img.size[0]}x{img.size[1]} for preview...")
+
+    def sweep_intermediate(self, img: Image, key: tuple, func):
+        """
+        Return intermediate result of input image, calculated only once while the same
+        image object is processed. Still image processed amount times is the same object
+        in every frame, so frames of a keyframed sweep reuse results of stages whose
+        parameters do not change. Results must not be changed by caller.
 
-        return (rimg, sort_params)
+        :param img: Input image
+        :type img: Image
+        :param key: Tuple with name of stage and all its parameters
+        :type key: tuple
+        :param func: Function which calculates result
+
+        :returns: Result of func
+        """
+        # single image is processed once, nothing to keep
+        if self.options.am.value < 2:
+            return func()
+
+        # reference to source keeps it alive, so another image can not take its place
+        if img is not self.sweep_source:
+            self.sweep_source = img
+            self.sweep_token = object()
+            self.sweep_cache.clear()
+
+        if key in self.sweep_cache:
+            self.sweep_cache.move_to_end(key)
+            return self.sweep_cache[key]
+
+        result = func()
+
+        self.sweep_cache[key] = result
+        if len(self.sweep_cache) > SWEEP_CACHE_SIZE:
+            self.sweep_cache.popitem(last=False)
+
+        return result
+
+    def get_resized_mask(self, size: tuple) -> Image:
+        """Return mask image resized to size, resized masks are kept."""
+        if size not in self.resized_masks:
+            if len(self.resized_masks) >= SWEEP_CACHE_SIZE:
+                self.resized_masks.clear()
+
+            self.resized_masks[size] = self.mask_image.resize(size)
+
+        return self.resized_masks[size]
+
+    def get_sort_mask(self, size: tuple, angle: int) -> Image:
+        """
+        Return mask of sortable pixels of image with size rotated by angle, 1 for pixels
+        which are sorted and 0 for pixels which are kept. Masks are kept for every size and angle.
+
+        :param size: Size of image before rotation
+        :type size: tuple
+        :param angle: Rotation angle, 0 for rotation free sorting
+        :type angle: int
+
+        :returns: "L" Image object or None if there is no mask
+        :rtype: Image
+        """
+        if self.options.m.value == "":
+            return None
+
+        if (size, angle) not in self.sort_masks:
+            if len(self.sort_masks) >= SWEEP_CACHE_SIZE:
+                self.sort_masks.clear()
+
+            # white parts of mask image are sorted, mask_image is inverted
+            mask = self.get_resized_mask(size).point(lambda v: 1 if v < 128 else 0)
+            # rotated the same way as image, corners are not sorted anyway
+            self.sort_masks[(size, angle)] = mask.rotate(angle, expand=True) if angle % 360 != 0 else mask
+
+        return self.sort_masks[(size, angle)]
+
+    def seed_random(self, i: int) -> None:
+        """
+        Give sorting engine its own random generator for image, if seed is set.
+        Generator depends only on seed and number of image, so output does not depend
+        on which process sorts image and in which order. In incremental mode every frame
+        gets the same generator, even without seed, so random segment layout is pinned.
+
+        :param i: Number of image
+        :type i: int
+        """
+        seed = self.options.sd.value
+        if self.incremental:
+            i = 0
+            if seed is None:
+                seed = self.incremental_seed
+
+        if seed is not None:
+            self.sorting_engine.random = random.Random(f"{seed}:{i}")
+
+    def result_cache_key(self, img: Image, i: int, sort_params: SortParams,
+                         sp_sort_params: SortParams) -> str:
+        """
+        Calculate result cache key from image content and everything that changes output.
+
+        :param img: Image object
+        :type img: Image
+        :param i: Number of image
+        :type i: int
+        :param sort_params: SortParams object of first pass
+        :type sort_params: SortParams
+        :param sp_sort_params: SortParams object of second pass
+        :type sp_sort_params: SortParams
+
+        :returns: Cache key, or None if cache is disabled or output is random
+        :rtype: str
+        """
+        if self.result_cache is None:
+            return None
+
+        random_segmentation = self.options.sg.value in RANDOM_SEGMENTATIONS
+        if random_segmentation and self.options.sd.value is None:
+            return None
+
+        from result_cache import digest
+
+        options = [(short, getattr(self.options, short).value) for short in RESULT_KEY_OPTIONS]
+
+        return digest(RESULT_CACHE_VERSION, img.size, options,
+                      sorted(vars(sort_params).items()), sorted(vars(sp_sort_params).items()),
+                      # random values depend on number of image, unless layout is pinned
+                      (0 if self.incremental else i) if random_segmentation else None,
+                      self.mask_digest,
+                      self.sweep_intermediate(img, ("digest",), lambda: digest(img.size, img.tobytes())))
 
     def get_crop_rectangle(self, rimg_size: tuple) -> tuple:
         """
@@ -332,16 +1267,20 @@ class PixelSort:
     def save_file(self, sort_params: SortParams, i: int, imgs: list) -> None:
         """
         Save image (or images) to file.
-        If len(imgs) > 1, images will be saved to one multi frame file.
+        If imgs has more than one image, images will be saved to one multi frame file.
 
         :param sort_params: SortParams object.
         :type sort_params: SortParams
         :param i: Image number.
         :type i: int
-        :param imgs: list with Image objects to save.
+        :param imgs: list or iterator with Image objects to save.
         :type imgs: list
         """
-        if len(imgs) == 0:
+        imgs = iter(imgs)
+        first_img = next(imgs, None)
+        second_img = next(imgs, None)
+
+        if first_img is None:
             self.logger.debug("Empty array passed to save_file function arguments.")
             return
 
@@ -350,15 +1289,76 @@ class PixelSort:
 
         self.logger.info(f"Saving to {file_path}...")
 
-        if len(imgs) == 1: # save to single frame file
-            imgs[0].save(file_path, quality=95)
+        if second_img is None: # save to single frame file
+            first_img.save(file_path, quality=95)
 
-        else: # save to multi frame file
-            imgs[0].save(file_path, quality=95, save_all=True,
-                         append_images=imgs[1:], loop=0)
+        else: # save to multi frame file, frames are taken from imgs while saving
+            first_img.save(file_path, quality=95, save_all=True,
+                           append_images=itertools.chain([second_img], imgs), loop=0)
 
         self.logger.info("Saved.")
 
+    def save_animation(self, results, palette: list=None, duration: int=None) -> None:
+        """
+        Save frames to animated GIF file while they are processed.
+
+        :param results: Iterator of tuples with frame number, Image object and SortParams object
+        :param palette: Global palette, if None it is calculated from first frames
+        :type palette: list
+        :param duration: Duration of every frame in milliseconds
+        :type duration: int
+        """
+        from gif_writer import GifWriter
+
+        writer = None
+
+        try:
+            for i, rimg, sort_params in results:
+                if writer is None:
+                    file_path = Path(self.generate_file_path(sort_params, 1))
+                    os.makedirs(file_path.parent, exist_ok=True)
+
+                    self.logger.info(f"Saving to {file_path}...")
+                    writer = GifWriter(file_path, palette, duration)
+
+                writer.write(rimg)
+        except BaseException:
+            # partial file is not left on disk and writer thread does not wait forever
+            if writer is not None:
+                writer.abort()
+            raise
+
+        if writer is None:
+            return
+
+        writer.close()
+        self.logger.info("Saved.")
+
+    def save_raw(self, results) -> None:
+        """
+        Save all frames to stdout, .raw or .npy file while they are processed.
+
+        :param results: Iterator of tuples with frame number, Image object and SortParams object
+        """
+        writer = None
+
+        for i, rimg, sort_params in results:
+            if writer is None:
+                if raw_io.is_stdio(self.options.o.value):
+                    file_path = raw_io.STDIO_PATH
+                    self.logger.info("Writing to stdout...")
+                else:
+                    file_path = Path(self.generate_file_path(sort_params, 1))
+                    os.makedirs(file_path.parent, exist_ok=True)
+                    self.logger.info(f"Saving to {file_path}...")
+
+                writer = raw_io.get_raw_writer(file_path, rimg.size, self.options.am.value)
+
+            writer.write(rimg)
+
+        writer.close()
+        self.logger.info("Saved.")
+
     def generate_file_path(self, sort_params: SortParams, i: int=None):
         """
         Generate and return file path for output image.
@@ -372,7 +1372,7 @@ class PixelSort:
         """
 
         folder = self.img_path.parent
-        filename = self.img_path.stem
+        filename = self.img_path.stem if not raw_io.is_stdio(self.img_path) else "stdin"
 
         output_path = Path(self.options.o.value)
 
@@ -380,24 +1380,29 @@ class PixelSort:
             folder = output_path
         else:                        # output argument is file
             if self.options.am.value == 1 and self.img_count == 1:
+                if self.options.pv.value:
+                    return str(output_path.with_name(f"{output_path.stem}_preview{output_path.suffix}"))
                 return self.options.o.value
             else: # if amount is greater than one
                 folder = output_path.parent
                 filename = output_path.stem            
 
         for option in self.options.__dict__.values():
-            if option.name == "amount" and self.get_out_ext() == ".gif":
+            if option.name == "amount" and self.get_out_ext() in MULTI_FRAME_EXTS:
                 option.show = True
             if option.show and option.value != option.default:
-                if option.isvariable and self.get_out_ext() != ".gif":
+                if option.isvariable and self.get_out_ext() not in MULTI_FRAME_EXTS:
                     filename += f"_{option.short}" + \
                                 str(getattr(sort_params, option.short))
                 elif option.val_type == bool or option.name == "mask":
                     filename += f"_{option.short}"
+                elif option.name == "skey_expr": # expression may have characters not allowed in filenames
+                    filename += f"_{option.short}_{hashlib.blake2b(option.value.encode(), digest_size=4).hexdigest()}"
                 else:
                     filename += f"_{option.short}_{option.value}"
 
         filename += f"_{i:04}" if i != None else ""
+        filename += "_preview" if self.options.pv.value else ""
         filename += self.get_out_ext()
 
         file_path = folder / filename
@@ -406,7 +1411,19 @@ class PixelSort:
 
     def get_out_ext(self):
         """Get output image file extension."""
-        return self.img_path.suffix if self.options.e.value == 'same' else self.options.e.value
+        if self.options.e.value != 'same':
+            return self.options.e.value
+
+        return self.img_path.suffix if not raw_io.is_stdio(self.img_path) else raw_io.RAW_EXT
+
+    def get_save_ext(self):
+        """Get extension of saved file, output file path is used as is for one image."""
+        output_path = Path(self.options.o.value)
+
+        if output_path.suffix != "" and self.options.am.value == 1 and self.img_count == 1:
+            return output_path.suffix.lower()
+
+        return self.get_out_ext()
 
     def get_image_filenames(self) -> list:
         """
@@ -417,6 +1434,9 @@ class PixelSort:
         """
         input_path = Path(self.options.input_path.value)
 
+        if raw_io.is_stdio(self.options.input_path.value):
+            return [input_path]
+
         if input_path.is_dir():
             # return all images with supported extension in dir
             return list([
@@ -433,6 +1453,40 @@ class PixelSort:
         self.logger.critical(f"Input path is invalid, exiting...")
         exit(1)
 
+# worker process state, process_files_parallel runs one app object per worker
+worker_app = None
+
+def init_worker(options: Options, img_count: int, log_queue) -> None:
+    """Initialize worker process of process_files_parallel."""
+    global worker_app
+    import logging.handlers
+    import multiprocessing
+
+    worker_app = PixelSort()
+    worker_app.options = options
+    worker_app.img_count = img_count
+
+    # do not write to handlers inherited from parent process, send records to it instead
+    logging.getLogger("pixelsort").handlers.clear()
+
+    worker_app.logger = logging.getLogger(f"pixelsort.{multiprocessing.current_process().name}")
+    worker_app.logger.setLevel("DEBUG")
+    worker_app.logger.propagate = False
+    worker_app.logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    # workers do not start pools of their own
+    worker_app.options.fj.value = 1
+
+    worker_app.prepare()
+
+def run_worker_file(img_path: Path) -> tuple:
+    """Process image file in worker process."""
+    return worker_app.run_file(img_path)
+
+def run_worker_frame(img: Image, i: int) -> tuple:
+    """Process frame in worker process."""
+    return worker_app.process_image(img, i)
+
 if __name__ == "__main__":
     app = PixelSort()
     app.main()
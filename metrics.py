@@ -0,0 +1,155 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import sys
+import time
+
+# Timing and memory of processing stages.
+# Every stage is written as one JSON line as soon as it ends, so worker processes
+# can write records to the same file. Prometheus text is made from records
+# when the whole run is done.
+
+# labels which are not aggregated in Prometheus output
+RECORD_ONLY_LABELS = ["time", "pid", "file", "frame", "seconds", "rss", "rss_peak", "rss_peak_increase"]
+
+DISABLED_STAGE = nullcontext()
+
+def rss() -> int:
+    """Return current resident memory of process in bytes, or None if it is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss() -> int:
+    """Return peak resident memory of process in bytes, or None if it is not available."""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak*1024
+
+class Metrics(object):
+    """
+    Recorder of stage metrics. If path is empty, recording is disabled and
+    stage returns context manager which does nothing.
+    """
+    def __init__(self, path: str="", metrics_format: str="jsonl", labels: dict=None):
+        """
+        :param path: Output file path, if empty, metrics are disabled
+        :type path: str
+        :param metrics_format: Output format, "jsonl" or "prometheus"
+        :type metrics_format: str
+        :param labels: Labels added to every record
+        :type labels: dict
+        """
+        self.enabled = bool(path)
+        self.path = path
+        self.metrics_format = metrics_format
+        self.labels = labels or {}
+
+        # prometheus output is made from records when run is done
+        self.records_path = path if metrics_format == "jsonl" else f"{path}.records"
+
+    def stage(self, name: str, **labels):
+        """
+        Return context manager which records duration and memory of stage.
+
+        :param name: Stage name
+        :type name: str
+        """
+        if not self.enabled:
+            return DISABLED_STAGE
+
+        return self.record(name, labels)
+
+    @contextmanager
+    def record(self, name: str, labels: dict):
+        """Record stage, used by stage method."""
+        start_peak = peak_rss()
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter()-start_time
+            end_peak = peak_rss()
+
+            self.write({
+                "time": round(time.time(), 3), "pid": os.getpid(), "stage": name,
+                **self.labels, **labels,
+                "seconds": round(seconds, 6), "rss": rss(), "rss_peak": end_peak,
+                "rss_peak_increase": end_peak-start_peak if end_peak is not None else None
+            })
+
+    def write(self, record: dict) -> None:
+        """Append record to records file."""
+        with open(self.records_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def reset(self) -> None:
+        """Remove records of previous run, called before processing starts."""
+        if self.enabled and os.path.exists(self.records_path):
+            os.remove(self.records_path)
+
+    def finish(self) -> None:
+        """Write Prometheus text from records, called after processing is done."""
+        if not self.enabled or self.metrics_format != "prometheus" or not os.path.exists(self.records_path):
+            return
+
+        with open(self.records_path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+        with open(self.path, "w") as f:
+            f.write(to_prometheus(records))
+
+        os.remove(self.records_path)
+
+def to_prometheus(records: list) -> str:
+    """
+    Aggregate records to Prometheus text format.
+    Durations are summaries (sum and count), memory is maximum of stage.
+
+    :param records: List of record dicts
+    :type records: list
+
+    :returns: Prometheus text
+    :rtype: str
+    """
+    seconds = defaultdict(float)
+    counts = defaultdict(int)
+    peaks = defaultdict(int)
+    increases = defaultdict(int)
+
+    for record in records:
+        labels = tuple(sorted((key, str(value)) for key, value in record.items()
+                              if key not in RECORD_ONLY_LABELS))
+
+        seconds[labels] += record["seconds"]
+        counts[labels] += 1
+        peaks[labels] = max(peaks[labels], record["rss_peak"] or 0)
+        increases[labels] = max(increases[labels], record["rss_peak_increase"] or 0)
+
+    def label_string(labels: tuple) -> str:
+        return ",".join(f'{key}="{value}"' for key, value in labels)
+
+    lines = ["# HELP pixelsort_stage_seconds Duration of processing stage.",
+             "# TYPE pixelsort_stage_seconds summary"]
+    for labels in seconds:
+        lines.append(f"pixelsort_stage_seconds_sum{{{label_string(labels)}}} {round(seconds[labels], 6)}")
+        lines.append(f"pixelsort_stage_seconds_count{{{label_string(labels)}}} {counts[labels]}")
+
+    lines += ["# HELP pixelsort_stage_rss_peak_bytes Peak resident memory of process after stage.",
+              "# TYPE pixelsort_stage_rss_peak_bytes gauge"]
+    lines += [f"pixelsort_stage_rss_peak_bytes{{{label_string(labels)}}} {peaks[labels]}" for labels in peaks]
+
+    lines += ["# HELP pixelsort_stage_rss_peak_increase_bytes Largest increase of peak resident memory during stage.",
+              "# TYPE pixelsort_stage_rss_peak_increase_bytes gauge"]
+    lines += [f"pixelsort_stage_rss_peak_increase_bytes{{{label_string(labels)}}} {increases[labels]}" for labels in increases]
+
+    return "\n".join(lines) + "\n"
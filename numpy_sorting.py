@@ -0,0 +1,725 @@
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import array_utils
+import edge_maps
+import key_expr
+import key_tables
+import line_maps
+import sort_backends
+from constants import BAND_MIN_PIXELS, RANDOM_SEGMENTATIONS
+from options import Options
+from sorting import SortingEngine
+from utils import SortParams
+
+def slice_bounds(starts, ends, length):
+    """
+    Return bounds of slices [starts:ends] of sequence with given length,
+    normalized the same way as python slicing does.
+
+    :param starts: Array of slice starts
+    :param ends: Array of slice ends
+    :param length: Length of sliced sequence (or array of lengths)
+
+    :returns: Tuple of normalized starts and ends, ends >= starts.
+    :rtype: tuple
+    """
+    starts = np.where(starts < 0, np.maximum(starts+length, 0), np.minimum(starts, length))
+    ends = np.where(ends < 0, np.maximum(ends+length, 0), np.minimum(ends, length))
+
+    return (starts, np.maximum(ends, starts))
+
+def split_segments(starts, ends, reverse, mask) -> tuple:
+    """
+    Split segments to runs of sortable pixels, pixels outside of mask are left out.
+    Runs of every segment follow each other, so overlapping segments are still
+    sorted in the same order.
+
+    :param starts: Array of segment start indices
+    :param ends: Array of segment end indices
+    :param reverse: Reverse flag or array of reverse flags of segments
+    :param mask: (N,) bool array, True for sortable pixels
+
+    :returns: Tuple of start indices, end indices and reverse flags of runs.
+    :rtype: tuple
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    changes = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    run_starts = np.flatnonzero(changes == 1)
+    run_ends = np.flatnonzero(changes == -1)
+
+    # runs from first run which ends after segment start to last run which starts before segment end
+    first = np.searchsorted(run_ends, starts, side="right")
+    counts = np.maximum(np.searchsorted(run_starts, ends, side="left") - first, 0)
+
+    segments = np.repeat(np.arange(starts.size), counts)
+    runs = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts) + np.repeat(first, counts)
+
+    if np.ndim(reverse) > 0:
+        reverse = np.asarray(reverse)[segments]
+
+    return (np.maximum(starts[segments], run_starts[runs]),
+            np.minimum(ends[segments], run_ends[runs]), reverse)
+
+def symmetrical_permutation(lengths, offsets):
+    """
+    Return permutation which makes every segment symmetrical,
+    same as array[::2] + array[1::2][::-1] for every segment.
+
+    :param lengths: Array of segment lengths
+    :param offsets: Array of segment offsets in permuted array
+
+    :returns: Array of source indices
+    """
+    lengths_rep = np.repeat(lengths, lengths)
+    offsets_rep = np.repeat(offsets, lengths)
+
+    local = np.arange(lengths_rep.size) - offsets_rep
+    half = (lengths_rep+1)//2
+
+    return offsets_rep + np.where(local < half, 2*local, 2*(lengths_rep-1-local)+1)
+
+class NumpySortingEngine(SortingEngine):
+    """
+    Sorting engine working on numpy pixel buffers.
+    Every segmentation produces segment bounds, then all segments are sorted in one pass.
+    Produces the same output as SortingEngine when given the same random draws.
+    """
+    def __init__(self, options: Options, rng: random.Random=None, use_tables: bool=True):
+        """
+        :param options: Options object
+        :type options: Options
+        :param rng: Random number generator of random segmentations,
+                    if None, global generator of random module is used
+        :type rng: random.Random
+        :param use_tables: Look up hue, lightness and saturation in tables cached on disk,
+                           if False, they are calculated without touching filesystem
+        :type use_tables: bool
+        """
+        super().__init__(options, rng)
+
+        self.use_tables = use_tables
+        self.keys = None
+        self.line_map = None
+        self.mask_data = None
+        # (input key, sorting key, keys) of last image with known content
+        self.cached_keys = (None, None, None)
+
+        self.threads = self.options.th.value or os.cpu_count()
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        # separate pool, because channels wait for bands sorted in the main pool
+        self.plane_executor = ThreadPoolExecutor(3) if self.threads > 1 and self.options.de.value else None
+
+    def close(self) -> None:
+        """Shut down thread pools."""
+        for executor in (self.executor, self.plane_executor):
+            if executor is not None:
+                executor.shutdown()
+
+        self.executor = None
+        self.plane_executor = None
+
+    def split_bands(self, lengths) -> list:
+        """
+        Split segments to bands with roughly equal amount of pixels, one band per thread.
+
+        :param lengths: Array of segment lengths
+
+        :returns: List of (first segment, end segment) tuples
+        :rtype: list
+        """
+        total = int(lengths.sum())
+        count = min(self.threads, max(total // BAND_MIN_PIXELS, 1))
+
+        cuts = np.searchsorted(np.cumsum(lengths), np.arange(1, count)*total/count)
+        cuts = [0] + np.unique(cuts).tolist() + [lengths.size]
+
+        return [(cuts[i], cuts[i+1]) for i in range(len(cuts)-1) if cuts[i] < cuts[i+1]]
+
+    def map_bands(self, func, bands: list) -> None:
+        """
+        Call func for every band, in threads if there are more than one.
+        Numpy releases the GIL while sorting and gathering, so bands are sorted concurrently.
+
+        :param func: Function which takes band start and band end
+        :param bands: List of (start, end) tuples
+        :type bands: list
+        """
+        if self.executor is None or len(bands) < 2:
+            for start, end in bands:
+                func(start, end)
+            return
+
+        for future in [self.executor.submit(func, start, end) for start, end in bands]:
+            future.result()
+
+    def to_lines(self, array):
+        """Reorder per-pixel array, so every scan line is contiguous."""
+        if self.line_map is None:
+            return array
+        return array[self.line_map.order]
+
+    def from_lines(self, array):
+        """Reorder per-pixel array back to image order."""
+        if self.line_map is None:
+            return array
+
+        result = np.empty_like(array)
+        result[self.line_map.order] = array
+        return result
+
+    def calc_keys(self, pixels):
+        """
+        Calculate sorting keys of pixels.
+
+        :param pixels: (N, 3) uint8 array
+
+        :returns: (N,) uint8 array
+        """
+        if self.options.se.value:
+            skey = key_expr.array_key(self.options.se.value)
+            expression = key_expr.parse(self.options.se.value)
+
+            # simple expressions are faster than table lookup
+            if self.use_tables and expression.uses_hls:
+                array_skey = skey
+                skey = lambda pixels: key_tables.lookup(expression.table_name, pixels, array_skey)
+        elif self.use_tables and self.options.sk.value in key_tables.TABLE_KEYS:
+            skey = lambda pixels: key_tables.lookup(self.options.sk.value, pixels)
+        else:
+            skey = getattr(array_utils, self.options.sk.value)
+
+        keys = np.empty(len(pixels), dtype=np.uint8)
+
+        def calc_band(start: int, end: int) -> None:
+            keys[start:end] = skey(pixels[start:end])
+
+        step = max(-(-len(pixels) // self.threads), BAND_MIN_PIXELS)
+        self.map_bands(calc_band, [(start, min(start+step, len(pixels)))
+                                   for start in range(0, len(pixels), step)])
+
+        return keys
+
+    def calc_sortable_keys(self, pixels):
+        """
+        Calculate sorting keys of sortable pixels, keys of pixels outside of mask are 0.
+
+        :param pixels: (N, 3) uint8 array
+
+        :returns: (N,) uint8 array
+        """
+        if self.mask_data is None:
+            return self.calc_keys(pixels)
+
+        keys = np.zeros(len(pixels), dtype=np.uint8)
+        keys[self.mask_data] = self.calc_keys(pixels[self.mask_data])
+
+        return keys
+
+    def calc_image_keys(self):
+        """
+        Calculate sorting keys of image pixels. Keys of image with the same input key
+        as previous image are copied from previous image, because sorting reorders them.
+
+        :returns: (N,) uint8 array
+        """
+        cached_input_key, cached_skey, cached_keys = self.cached_keys
+
+        skey = (self.options.sk.value, self.options.se.value)
+        if self.input_key is not None and (cached_input_key, cached_skey) == (self.input_key, skey):
+            return cached_keys.copy()
+
+        keys = self.calc_sortable_keys(self.image_data)
+
+        if self.input_key is not None:
+            self.cached_keys = (self.input_key, skey, keys.copy())
+
+        return keys
+
+    def argsort(self, keys, segment_ids=None):
+        """
+        Return stable order of keys sorted within segments, using selected sort backend.
+        Counting sort is used only for 8 or 16-bit keys, other keys fall back to comparison sort.
+
+        :param keys: (N,) array of sorting keys
+        :param segment_ids: (N,) int64 array of non-decreasing segment ids, or None for one segment
+
+        :returns: (N,) array of indices
+        """
+        backend = self.options.sb.value
+
+        if backend == "auto":
+            # one counting pass over segment ids is faster than comparison sort,
+            # more passes are not worth it, because segments are small then
+            few_segments = segment_ids is None or segment_ids.size == 0 or segment_ids[-1] < 1 << 16
+            backend = "counting" if few_segments else "comparison"
+
+        if backend == "counting" and not sort_backends.is_narrow(keys):
+            backend = "comparison"
+
+        return getattr(sort_backends, backend+"_argsort")(keys, segment_ids)
+
+    def calc_rows(self) -> list:
+        """
+        Calculate bounds of every row.
+
+        :returns: List of tuples with relative left bound, relative right bound,
+                  start index and length of row.
+        :rtype: list
+        """
+        if self.line_map is not None:
+            return self.line_map.rows()
+
+        rows = []
+        for y in range(self.image_size[1]):
+            rstart, rend, start, end = self.calc_bounds(y)
+            start, end, _ = slice(start, end).indices(len(self.image_data))
+
+            rows.append((rstart, rend, start, max(end-start, 0)))
+
+        return rows
+
+    def calc_segments(self) -> tuple:
+        """
+        Calculate segments of selected segmentation.
+
+        :returns: Tuple of start indices, end indices and reverse flags of segments.
+        :rtype: tuple
+        """
+        segments = getattr(self, self.options.sg.value+"_segments")()
+
+        if self.mask_data is not None:
+            return split_segments(*segments, self.mask_data)
+
+        return segments
+
+    def sort_data(self, data, keys, segments: tuple) -> None:
+        """
+        Sort pixel data in place.
+
+        :param data: (N, 3) array of pixels or (N,) array of one channel
+        :param keys: (N,) array of sorting keys, is reordered together with data
+        :param segments: Tuple returned by calc_segments
+        :type segments: tuple
+        """
+        if self.options.sg.value == "none":
+            self.sort_global(data, keys, *segments)
+        else:
+            self.sort_segments(data, keys, *segments)
+
+    def sort_global(self, data, keys, starts, ends, reverse) -> None:
+        """
+        Sort pixels of all rows together, symmetry is applied to every row.
+
+        :param data: Pixel data
+        :param keys: Sorting keys
+        :param starts: Absolute start indices of rows
+        :param ends: Absolute end indices of rows
+        :param reverse: Reverse flag
+        """
+        lengths = ends - starts
+        offsets = np.cumsum(lengths) - lengths
+
+        indices = np.arange(lengths.sum()) - np.repeat(offsets-starts, lengths)
+
+        row_keys = keys[indices]
+        order = self.argsort(~row_keys if reverse else row_keys)
+
+        if self.sm:
+            order = order[symmetrical_permutation(lengths, offsets)]
+
+        data[indices] = data[indices[order]]
+
+    def concatenate_segments(self, starts: list, ends: list, reverse) -> tuple:
+        """
+        Concatenate segments of every row.
+
+        :param starts: List of arrays with start indices
+        :type starts: list
+        :param ends: List of arrays with end indices
+        :type ends: list
+        :param reverse: Reverse flag or list of arrays with reverse flags
+
+        :returns: Tuple of start indices, end indices and reverse flags of segments.
+        :rtype: tuple
+        """
+        if not starts:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), reverse)
+
+        return (np.concatenate(starts), np.concatenate(ends),
+                np.concatenate(reverse) if isinstance(reverse, list) else reverse)
+
+    def sort_segments(self, data, keys, starts, ends, reverse) -> None:
+        """
+        Sort all segments of image.
+        Segments are sorted in one pass, segments which overlap previous segment
+        are sorted in next passes, so result is the same as sorting them one by one.
+
+        :param data: Pixel data
+        :param keys: Sorting keys
+        :param starts: Absolute start indices of segments in ascending order
+        :param ends: Absolute end indices of segments
+        :param reverse: Reverse flag of every segment
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        reverse = np.broadcast_to(np.asarray(reverse, dtype=bool), starts.shape)
+
+        # segments shorter than 2 pixels do not change anything
+        keep = ends-starts > 1
+        starts, ends, reverse = starts[keep], ends[keep], reverse[keep]
+
+        if starts.size == 0:
+            return
+
+        overlaps = np.zeros(starts.size, dtype=bool)
+        overlaps[1:] = starts[1:] < np.maximum.accumulate(ends)[:-1]
+
+        # layer is number of overlapping segments right before segment
+        numbers = np.arange(starts.size)
+        layers = numbers - np.maximum.accumulate(np.where(overlaps, 0, numbers))
+
+        for layer in range(layers.max()+1):
+            mask = layers == layer
+            self.sort_layer(data, keys, starts[mask], ends[mask]-starts[mask], reverse[mask])
+
+    def sort_layer(self, data, keys, starts, lengths, reverse) -> None:
+        """
+        Sort non-overlapping segments, bands of segments are sorted concurrently.
+
+        :param data: Pixel data
+        :param keys: Sorting keys
+        :param starts: Absolute start indices of segments in ascending order
+        :param lengths: Lengths of segments
+        :param reverse: Reverse flag of every segment
+        """
+        def sort_band(first: int, end: int) -> None:
+            self.sort_band(data, keys, starts[first:end], lengths[first:end], reverse[first:end])
+
+        self.map_bands(sort_band, self.split_bands(lengths))
+
+    def sort_band(self, data, keys, starts, lengths, reverse) -> None:
+        """
+        Sort non-overlapping segments in one stable (segment, key) ordering.
+
+        :param data: Pixel data
+        :param keys: Sorting keys
+        :param starts: Absolute start indices of segments in ascending order
+        :param lengths: Lengths of segments
+        :param reverse: Reverse flag of every segment
+        """
+        offsets = np.cumsum(lengths) - lengths
+        indices = np.arange(lengths.sum()) - np.repeat(offsets-starts, lengths)
+        segment_ids = np.repeat(np.arange(starts.size, dtype=np.int64), lengths)
+
+        segment_keys = keys[indices]
+        # inverting uint8 keys keeps sort stable for reverse order, like sorted() does
+        segment_keys = np.where(np.repeat(reverse, lengths), ~segment_keys, segment_keys)
+
+        order = self.argsort(segment_keys, segment_ids)
+
+        if self.sm:
+            order = order[symmetrical_permutation(lengths, offsets)]
+
+        data[indices] = data[indices[order]]
+        keys[indices] = keys[indices[order]]
+
+    def sort_image(self, *, sort_params: SortParams, image: Image, og_image_size: tuple,
+                   first_row: int=0, continued: bool=False, input_key=None, mask: Image=None) -> None:
+        """
+        Sort image.
+
+        :param sort_params: SortParams object
+        :type sort_params: SortParams
+        :param image: Image object
+        :type image: Image
+        :param og_image_size: Original image size
+        :type og_image_size: tuple
+        :param first_row: Number of first row, if image is a strip of bigger image
+        :type first_row: int
+        :param continued: If True, image is next strip of the same image and
+                          state of chunky segmentation is carried over from previous strip
+        :type continued: bool
+        :param input_key: Hashable key of image content, images with the same key have the same
+                          content, so their keys and edge maps are reused. If None, content is not known.
+        :param mask: "L" Image of the same size as image, pixels with value 0 are not sorted
+                     and split segments. If None, every pixel is sorted.
+        :type mask: Image
+        """
+
+        self.sort_params = sort_params
+        self.image = image
+        self.og_image_size = og_image_size
+        self.input_key = input_key
+
+        self.image_size = self.image.size
+
+        # sort along scan lines of unrotated image
+        if self.options.rf.value and self.sort_params.a % 360 != 0:
+            self.line_map = line_maps.get_line_map(*self.image_size, self.sort_params.a)
+
+        self.image_data = self.to_lines(np.array(self.image).reshape(-1, 3))
+        self.mask_data = self.to_lines(np.asarray(mask).reshape(-1) != 0) if mask is not None else None
+
+        self.prepare_bounds()
+
+        self.first_row = first_row
+        self.channel = 0
+        if not continued:
+            self.chunky_offsets = [0, 0, 0]
+
+        self.re = self.options.re.value
+        self.sm = self.options.sm.value
+
+        if self.options.de.value:
+            self.sort_planes()
+        else:
+            with self.metrics.stage("keys"):
+                self.keys = self.calc_image_keys()
+
+            with self.metrics.stage("segments", method=self.options.sg.value):
+                segments = self.calc_segments()
+
+            with self.metrics.stage("sort", method=self.options.sg.value):
+                self.sort_data(self.image_data, self.keys, segments)
+
+        self.image.paste(Image.fromarray(
+            self.from_lines(self.image_data).reshape(self.image_size[1], self.image_size[0], 3)
+        ))
+
+        self.image_data = None
+        self.edge_image_data = None
+        self.keys = None
+        self.line_map = None
+        self.mask_data = None
+
+    def sort_planes(self) -> None:
+        """
+        Sort R, G and B channels separately, each by key of pixel with only that channel.
+        Segmentation is calculated once, unless it uses random values. Then it is
+        calculated for every channel in the same order as channels are sorted.
+        Channels are sorted concurrently if there are more threads.
+        """
+        segments = []
+        with self.metrics.stage("segments", method=self.options.sg.value):
+            for channel in range(3):
+                self.channel = channel
+
+                if channel == 0 or self.options.sg.value in RANDOM_SEGMENTATIONS:
+                    segments.append(self.calc_segments())
+                else:
+                    segments.append(segments[0])
+
+        planes = [np.ascontiguousarray(self.image_data[:, channel]) for channel in range(3)]
+
+        def sort_plane(channel: int) -> None:
+            pixels = np.zeros_like(self.image_data)
+            pixels[:, channel] = planes[channel]
+
+            self.sort_data(planes[channel], self.calc_sortable_keys(pixels), segments[channel])
+
+        with self.metrics.stage("sort", method=self.options.sg.value):
+            if self.plane_executor is None:
+                for channel in range(3):
+                    sort_plane(channel)
+            else:
+                list(self.plane_executor.map(sort_plane, range(3)))
+
+        for channel in range(3):
+            self.image_data[:, channel] = planes[channel]
+
+    def bucket_pixels(self, image: Image) -> list:
+        """
+        Split pixels of image to buckets by sorting key, used to sort big images
+        with none segmentation out of memory.
+
+        :param image: RGB Image object
+        :type image: Image
+
+        :returns: List of 256 bytes objects with raw pixels of every key in original order
+        :rtype: list
+        """
+        pixels = np.asarray(image).reshape(-1, 3)
+        keys = self.calc_keys(pixels)
+
+        data = pixels[self.argsort(keys)].tobytes()
+        ends = np.cumsum(np.bincount(keys, minlength=256)*3).tolist()
+
+        return [data[start:end] for start, end in zip([0]+ends[:-1], ends)]
+
+    def none_segments(self) -> tuple:
+        """Calculate segments of none segmentation, every row is returned."""
+        rows = self.calc_rows()
+
+        return (np.array([row[2] for row in rows], dtype=np.int64),
+                np.array([row[2]+row[3] for row in rows], dtype=np.int64), self.re)
+
+    def row_segments(self) -> tuple:
+        """Calculate segments of row segmentation."""
+        rows = self.calc_rows()
+
+        return ([row[2] for row in rows], [row[2]+row[3] for row in rows], self.re)
+
+    def edge_segments(self) -> tuple:
+        """Calculate segments of edge segmentation, boundaries of all rows are found at once."""
+        self.edge_image_data = self.to_lines(np.frombuffer(
+            edge_maps.get_edge_map(self.image, self.options.ed.value, self.input_key), dtype=np.uint8
+        ))
+
+        t = self.sort_params.t
+        of = self.sort_params.of
+
+        rows = np.array([row[2:] for row in self.calc_rows()], dtype=np.int64).reshape(-1, 2)
+        rows = rows[rows[:, 1] > 0]
+
+        # rows without sortable pixels have no segments
+        if self.mask_data is not None:
+            counts = np.concatenate(([0], np.cumsum(self.mask_data)))
+            rows = rows[counts[rows[:, 0]+rows[:, 1]] > counts[rows[:, 0]]]
+        lengths = rows[:, 1]
+
+        # row and position within row of every pixel of all rows put together
+        offsets = np.cumsum(lengths) - lengths
+        row_ids = np.repeat(np.arange(lengths.size), lengths)
+        xs = np.arange(lengths.sum()) - offsets[row_ids]
+
+        # same indexing as edge_row[min(x-of, len(row)-1)]
+        indices = np.minimum(xs-of, lengths[row_ids]-1)
+        indices = np.clip(np.where(indices < 0, indices+lengths[row_ids], indices), 0, None)
+
+        boundaries = self.edge_image_data[rows[row_ids, 0]+indices] > t*255
+        boundaries[offsets+lengths-1] = True
+        boundaries = np.flatnonzero(boundaries)
+
+        boundary_rows = row_ids[boundaries]
+        boundary_xs = xs[boundaries]
+
+        # segment begins after previous boundary of the same row,
+        # boundary at x=0 is not skipped
+        begins = np.zeros_like(boundary_xs)
+        begins[1:] = boundary_xs[:-1]+1
+        first = np.ones(boundaries.size, dtype=bool)
+        first[1:] = (boundary_rows[1:] != boundary_rows[:-1]) | (boundary_xs[:-1] == 0)
+        begins[first] = 0
+
+        row_starts = rows[boundary_rows, 0]
+        return (row_starts+begins, row_starts+boundary_xs, self.re)
+
+    def melting_segments(self) -> tuple:
+        """Calculate segments of melting segmentation."""
+        sz = self.sort_params.sz
+
+        starts = []
+        ends = []
+
+        for rstart, rend, start, length in self.calc_rows():
+            width = sz*self.og_image_size[0]*(1-(0.5*(self.random.random()+0.5)))
+
+            if length == 0:
+                continue
+
+            first_width = width*self.random.random()
+
+            # x values in the same order of additions as x += width
+            steps = np.full(int((length-first_width)/width)+3, width)
+            steps[0] = 0
+            steps[1] = first_width
+            xs = np.add.accumulate(steps)
+
+            count = np.argmax(xs >= length)
+            xs = np.rint(xs[:count+1]).astype(np.int64)
+
+            segment_starts, segment_ends = slice_bounds(xs[:-1], xs[1:], length)
+            starts.append(start+segment_starts)
+            ends.append(start+segment_ends)
+
+        return self.concatenate_segments(starts, ends, self.re)
+
+    def blocky_segments(self) -> tuple:
+        """Calculate segments of blocky segmentation."""
+        sz = self.sort_params.sz
+        r = self.sort_params.r
+
+        starts = []
+        ends = []
+        reverse = []
+
+        for y, (rstart, rend, start, length) in enumerate(self.calc_rows()):
+            block_size = sz*self.og_image_size[0]
+            offset = round(block_size*r*(self.random.random() - 0.5))
+
+            x = (rstart//block_size)*block_size
+            first_iter = True
+
+            segment_starts = []
+            segment_ends = []
+
+            while x < rend:
+                last_x = max(round(x)-rstart, 0)
+
+                x += block_size + offset * first_iter
+                x = max(x, rstart)
+
+                if max(0, rend-x) <= -offset+1:
+                    x -= offset
+
+                segment_starts.append(last_x)
+                segment_ends.append(round(x)-rstart)
+
+                first_iter = False
+
+            segment_starts, segment_ends = slice_bounds(
+                np.array(segment_starts, dtype=np.int64),
+                np.array(segment_ends, dtype=np.int64), length
+            )
+            starts.append(start+segment_starts)
+            ends.append(start+segment_ends)
+            reverse.append(np.full(segment_starts.size, ((self.first_row+y)//block_size)%2 != self.re))
+
+        return self.concatenate_segments(starts, ends, reverse)
+
+    def chunky_segments(self) -> tuple:
+        """Calculate segments of chunky segmentation."""
+        l = self.sort_params.l
+        r = self.sort_params.r
+
+        chunky_offset = self.chunky_offsets[self.channel]
+
+        starts = []
+        ends = []
+
+        for rstart, rend, start, length in self.calc_rows():
+            if rend-rstart < 2:
+                continue
+
+            # x values in the same order of additions as x += l
+            steps = np.full(int((length+l-chunky_offset)/l)+3, l)
+            steps[0] = -(l-chunky_offset)
+            xs = np.add.accumulate(steps)
+
+            count = np.argmax(xs >= length)
+            xs = xs[:count+1]
+
+            offsets = np.array([round(l*r*(self.random.random() - 0.5)) for i in range(count)],
+                               dtype=np.int64)
+            last_offsets = np.zeros_like(offsets)
+            last_offsets[1:] = offsets[:-1]
+
+            segment_starts, segment_ends = slice_bounds(
+                np.rint(np.maximum(xs[:-1], 0)).astype(np.int64) + last_offsets,
+                np.rint(xs[1:] + offsets).astype(np.int64), length
+            )
+            starts.append(start+segment_starts)
+            ends.append(start+segment_ends)
+
+            chunky_offset = (((((length - chunky_offset) // l)+1) * l) + chunky_offset) % length
+
+        self.chunky_offsets[self.channel] = chunky_offset
+
+        return self.concatenate_segments(starts, ends, self.re)
@@ -103,6 +103,9 @@ class Options(object):
         self.m =  Option(name="mask", short="m", option_type=1,
                          default=OPTION_DEFAULTS["mask"], 
                          help_string=HELP_MASK, val_type=str, show=True)
+        self.rs = Option(name="raw_size", short="rs", option_type=1,
+                         default=OPTION_DEFAULTS["raw_size"], help_string=HELP_RAW_SIZE,
+                         val_type=str)
 
         self.ll = Option(name="loglevel", short="ll", option_type=1,
                          default=OPTION_DEFAULTS["loglevel"],
@@ -117,6 +120,9 @@ class Options(object):
                          default=OPTION_DEFAULTS["skey_choice"],
                          choices=SKEY_CHOICES, help_string=HELP_SKEY,
                          val_type=str, show=True)
+        self.se = Option(name="skey_expr", short="se", option_type=1,
+                         default=OPTION_DEFAULTS["skey_expr"], help_string=HELP_SKEY_EXPR,
+                         val_type=str, show=True)
 
         self.t =  Option(name="threshold", short="t", option_type=1,
                          default=OPTION_DEFAULTS["threshold"], help_string=HELP_THRESHOLD,
@@ -125,6 +131,10 @@ class Options(object):
                          default=OPTION_DEFAULTS["offset"],
                          help_string=HELP_OFFSET, val_type=int,
                          isvariable=True, show=True)
+        self.ed = Option(name="edge_detector", short="ed", option_type=1,
+                         default=OPTION_DEFAULTS["edge_detector"],
+                         choices=EDGE_DETECTOR_CHOICES, help_string=HELP_EDGE_DETECTOR,
+                         val_type=str, show=True)
         self.a =  Option(name="angle", short="a", option_type=1,
                          default=OPTION_DEFAULTS["angle"], help_string=HELP_ANGLE,
                          bounds=(0,360), val_type=int, isvariable=True, show=True)
@@ -151,6 +161,50 @@ class Options(object):
                          default=OPTION_DEFAULTS["height"], help_string=HELP_HEIGHT,
                          bounds=(0,None), val_type=int, isvariable=True, show=True)
 
+        self.en = Option(name="engine", short="en", option_type=1,
+                         default=OPTION_DEFAULTS["engine"],
+                         choices=ENGINE_CHOICES, help_string=HELP_ENGINE,
+                         val_type=str)
+        self.sb = Option(name="sort_backend", short="sb", option_type=1,
+                         default=OPTION_DEFAULTS["sort_backend"],
+                         choices=SORT_BACKEND_CHOICES, help_string=HELP_SORT_BACKEND,
+                         val_type=str)
+
+        self.th = Option(name="threads", short="th", option_type=1,
+                         default=OPTION_DEFAULTS["threads"], help_string=HELP_THREADS,
+                         bounds=(0,None), val_type=int)
+        self.j =  Option(name="jobs", short="j", option_type=1,
+                         default=OPTION_DEFAULTS["jobs"], help_string=HELP_JOBS,
+                         bounds=(0,None), val_type=int)
+        self.fj = Option(name="frame_jobs", short="fj", option_type=1,
+                         default=OPTION_DEFAULTS["frame_jobs"], help_string=HELP_FRAME_JOBS,
+                         bounds=(0,None), val_type=int)
+        self.mm = Option(name="max_memory", short="mm", option_type=1,
+                         default=OPTION_DEFAULTS["max_memory"], help_string=HELP_MAX_MEMORY,
+                         bounds=(0,None), val_type=int)
+
+        self.mt = Option(name="metrics", short="mt", option_type=1,
+                         default=OPTION_DEFAULTS["metrics"], help_string=HELP_METRICS,
+                         val_type=str)
+        self.mf = Option(name="metrics_format", short="mf", option_type=1,
+                         default=OPTION_DEFAULTS["metrics_format"],
+                         choices=METRICS_FORMAT_CHOICES, help_string=HELP_METRICS_FORMAT,
+                         val_type=str)
+        self.pf = Option(name="profile", short="pf", option_type=1,
+                         default=OPTION_DEFAULTS["profile"], help_string=HELP_PROFILE,
+                         val_type=str)
+
+        self.sd = Option(name="seed", short="sd", option_type=1,
+                         default=OPTION_DEFAULTS["seed"], help_string=HELP_SEED,
+                         val_type=int)
+        self.rc = Option(name="result_cache", short="rc", option_type=1,
+                         default=OPTION_DEFAULTS["result_cache"], help_string=HELP_RESULT_CACHE,
+                         bounds=(0,None), val_type=int)
+
+        self.pv = Option(name="preview", short="pv", option_type=1,
+                         default=OPTION_DEFAULTS["preview"], help_string=HELP_PREVIEW,
+                         bounds=(0,None), val_type=float)
+
         self.am = Option(name="amount", short="am", option_type=1,
                          default=OPTION_DEFAULTS["amount"], help_string=HELP_AMOUNT,
                          bounds=(1,None), val_type=int)
@@ -161,10 +215,16 @@ class Options(object):
                          help_string=HELP_REVERSE, show=True)
         self.pr = Option(name="preserve_res", short="pr", option_type=0,
                          help_string=HELP_PRESERVE_RES, show=True)
+        self.rf = Option(name="rotation_free", short="rf", option_type=0,
+                         help_string=HELP_ROTATION_FREE, show=True)
         self.sm = Option(name="symmetry", short="sm", option_type=0,
                          help_string=HELP_SYMMETRY, show=True)
         self.de = Option(name="decompose", short="de", option_type=0,
                          help_string=HELP_DECOMPOSE, show=True)
+        self.ic = Option(name="incremental", short="ic", option_type=0,
+                         help_string=HELP_INCREMENTAL, show=True)
+        self.rn = Option(name="refine", short="rn", option_type=0,
+                         help_string=HELP_REFINE)
 
         self.sl = Option(name="silent", short="sl", option_type=0,
                          help_string=HELP_SILENT)
@@ -1,42 +1,46 @@
 import colorsys
-from functools import cache
+from functools import lru_cache
 
-@cache
+from constants import PIXEL_CACHE_SIZE
+
+# caches are bounded, so long batch runs do not keep every color ever seen in memory
+
+@lru_cache(maxsize=PIXEL_CACHE_SIZE)
 def hue(pixel):
     """Return pixel hue."""
     return int(colorsys.rgb_to_hls(*[i/255 for i in pixel])[0]*255)
 
-@cache
+@lru_cache(maxsize=PIXEL_CACHE_SIZE)
 def lightness(pixel):
     """Return pixel lightness."""
     return int(colorsys.rgb_to_hls(*[i/255 for i in pixel])[1]*255)
 
-@cache
+@lru_cache(maxsize=PIXEL_CACHE_SIZE)
 def saturation(pixel):
     """Return pixel saturation."""
     return int(colorsys.rgb_to_hls(*[i/255 for i in pixel])[2]*255)
 
-@cache
+@lru_cache(maxsize=PIXEL_CACHE_SIZE)
 def min_value(pixel):
     """Return minimum value of pixel."""
     return min(pixel)
 
-@cache
+@lru_cache(maxsize=PIXEL_CACHE_SIZE)
 def max_value(pixel):
     """Return maximum value of pixel."""
     return max(pixel)
 
-@cache
+@lru_cache(maxsize=PIXEL_CACHE_SIZE)
 def red(pixel):
     """Return red color of pixel."""
     return pixel[0]
 
-@cache
+@lru_cache(maxsize=PIXEL_CACHE_SIZE)
 def green(pixel):
     """Return green color of pixel."""
     return pixel[1]
 
-@cache
+@lru_cache(maxsize=PIXEL_CACHE_SIZE)
 def blue(pixel):
     """Return blue color of pixel."""
     return pixel[2]
@@ -0,0 +1,223 @@
+import mmap
+import sys
+from pathlib import Path
+
+from PIL import Image
+
+# Raw rgb24 frames (stdin, stdout and .raw files) and .npy arrays.
+# Frames are read straight from file mapping or pipe buffer into Image objects
+# and written straight from them, without encoding.
+
+STDIO_PATH = "-"
+RAW_EXT = ".raw"
+NPY_EXT = ".npy"
+RAW_EXTS = [RAW_EXT, NPY_EXT]
+
+def is_stdio(path) -> bool:
+    """Return True if path means stdin or stdout."""
+    return str(path) == STDIO_PATH
+
+def is_raw_path(path) -> bool:
+    """Return True if path is stdin, stdout or raw file."""
+    return is_stdio(path) or Path(path).suffix.lower() in RAW_EXTS
+
+def parse_raw_size(value: str) -> tuple:
+    """
+    Parse size of raw frames.
+
+    :param value: String like "1920x1080" or "1920x1080x100" (with number of frames)
+    :type value: str
+
+    :returns: Tuple of width, height and number of frames (None if not set)
+    :rtype: tuple
+    """
+    parts = [int(part) for part in str(value).lower().split("x")]
+
+    if len(parts) not in (2, 3) or min(parts) < 1:
+        raise ValueError(f"Invalid raw size {value!r}, should be WIDTHxHEIGHT or WIDTHxHEIGHTxFRAMES")
+
+    return (parts[0], parts[1], parts[2] if len(parts) == 3 else None)
+
+class RawImage(object):
+    """
+    Sequence of raw RGB frames with the part of Image interface used by PixelSort:
+    size, mode, info, n_frames, seek, convert and getpalette.
+    """
+    def __init__(self, path, raw_size: str=""):
+        """
+        :param path: File path or "-" for stdin
+        :param raw_size: Size of raw frames, not needed for .npy files
+        :type raw_size: str
+        """
+        self.path = path
+        self.mode = "RGB"
+        self.info = {}
+        self.frame = 0
+        self.array = None
+        self.buffer = None
+
+        if is_stdio(path) or Path(path).suffix.lower() == RAW_EXT:
+            if not raw_size:
+                raise ValueError("Size of raw frames is not set")
+
+            width, height, frames = parse_raw_size(raw_size)
+            self.size = (width, height)
+            self.frame_size = width*height*3
+
+            if is_stdio(path):
+                self.file = sys.stdin.buffer
+                self.n_frames = frames or 1
+            else:
+                self.file = open(path, "rb")
+                self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.n_frames = frames or len(self.buffer) // self.frame_size
+        else:
+            import numpy as np
+
+            self.array = np.load(path, mmap_mode="r")
+            if self.array.dtype != np.uint8 or self.array.ndim not in (3, 4) or self.array.shape[-1] != 3:
+                raise ValueError(f"Array should be uint8 (height, width, 3) or (frames, height, width, 3), got {self.array.dtype} {self.array.shape}")
+
+            self.size = (self.array.shape[-2], self.array.shape[-3])
+            self.n_frames = self.array.shape[0] if self.array.ndim == 4 else 1
+
+        if self.n_frames < 1:
+            raise ValueError(f"{path} has no frames")
+
+    def seek(self, frame: int) -> None:
+        """Select frame, stdin can only be read forward."""
+        if is_stdio(self.path) and frame < self.frame:
+            raise ValueError("Can not seek back in stdin")
+
+        self.frame = frame
+
+    def tell(self) -> int:
+        """Return number of selected frame."""
+        return self.frame
+
+    def getpalette(self) -> None:
+        """Raw frames have no palette."""
+        return None
+
+    def convert(self, mode: str) -> Image:
+        """
+        Read selected frame.
+
+        :param mode: Image mode
+        :type mode: str
+
+        :returns: Image object
+        :rtype: Image
+        """
+        if self.array is not None:
+            frame = self.array[self.frame] if self.array.ndim == 4 else self.array
+            img = Image.fromarray(frame)
+            return img if mode == "RGB" else img.convert(mode)
+
+        if self.buffer is not None:
+            start = self.frame*self.frame_size
+            data = memoryview(self.buffer)[start:start+self.frame_size]
+        else:
+            data = bytearray(self.frame_size)
+            view = memoryview(data)
+
+            # stdin can be read by parts, read until frame is full
+            read = 0
+            while read < self.frame_size:
+                count = self.file.readinto(view[read:])
+                if not count:
+                    raise EOFError(f"stdin ended after {read} bytes of frame {self.frame+1}")
+                read += count
+
+        if len(data) != self.frame_size:
+            raise EOFError(f"{self.path} ended before frame {self.frame+1}")
+
+        try:
+            img = Image.frombuffer("RGB", self.size, data, "raw", "RGB", 0, 1)
+            return img if mode == "RGB" else img.convert(mode)
+        finally:
+            if isinstance(data, memoryview):
+                data.release()
+
+    def close(self) -> None:
+        """Close file."""
+        if self.buffer is not None:
+            self.buffer.close()
+            self.file.close()
+
+        self.array = None
+
+class RawWriter(object):
+    """Writer of raw RGB frames to stdout or .raw file."""
+    def __init__(self, path, size: tuple, n_frames: int):
+        """
+        :param path: File path or "-" for stdout
+        :param size: Frame size
+        :type size: tuple
+        :param n_frames: Number of frames
+        :type n_frames: int
+        """
+        self.path = path
+        self.file = sys.stdout.buffer if is_stdio(path) else open(path, "wb")
+
+    def write(self, img: Image) -> None:
+        """Write frame."""
+        self.file.write(img.tobytes())
+        self.file.flush()
+
+    def close(self) -> None:
+        """Close file, stdout is only flushed."""
+        if is_stdio(self.path):
+            self.file.flush()
+        else:
+            self.file.close()
+
+class NpyWriter(object):
+    """Writer of frames to memory mapped .npy file."""
+    def __init__(self, path, size: tuple, n_frames: int):
+        """
+        :param path: File path
+        :param size: Frame size
+        :type size: tuple
+        :param n_frames: Number of frames, if it is one, array has no frames axis
+        :type n_frames: int
+        """
+        import numpy as np
+        from numpy.lib.format import open_memmap
+
+        shape = (size[1], size[0], 3) if n_frames == 1 else (n_frames, size[1], size[0], 3)
+        self.array = open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+        self.frame = 0
+
+    def write(self, img: Image) -> None:
+        """Write frame."""
+        import numpy as np
+
+        if self.array.ndim == 4:
+            self.array[self.frame] = np.asarray(img)
+        else:
+            self.array[...] = np.asarray(img)
+
+        self.frame += 1
+
+    def close(self) -> None:
+        """Flush and close file."""
+        self.array.flush()
+        self.array = None
+
+def get_raw_writer(path, size: tuple, n_frames: int):
+    """
+    Create writer for stdout, .raw or .npy file.
+
+    :param path: File path or "-" for stdout
+    :param size: Frame size
+    :type size: tuple
+    :param n_frames: Number of frames
+    :type n_frames: int
+
+    :returns: RawWriter or NpyWriter object
+    """
+    if not is_stdio(path) and Path(path).suffix.lower() == NPY_EXT:
+        return NpyWriter(path, size, n_frames)
+
+    return RawWriter(path, size, n_frames)
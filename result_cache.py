@@ -0,0 +1,105 @@
+import hashlib
+import os
+from pathlib import Path
+
+from PIL import Image
+
+# Sorted images stored on disk by key of input content and sort parameters.
+# Files are written to temporary file first and replaced, so parallel processes
+# never read partial file. Reading a file updates its modification time, so
+# files are evicted in least recently used order.
+
+RESULT_EXT = ".ppm"
+
+def digest(*parts) -> str:
+    """
+    Return hex digest of parts.
+
+    :param parts: bytes objects or values with stable repr
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else repr(part).encode())
+
+    return h.hexdigest()
+
+class ResultCache(object):
+    """On-disk cache of output images with size limit."""
+    def __init__(self, folder: Path, max_size: int):
+        """
+        :param folder: Cache folder
+        :type folder: Path
+        :param max_size: Maximum size of all files in bytes
+        :type max_size: int
+        """
+        self.folder = Path(folder)
+        self.max_size = max_size
+
+    def path(self, key: str) -> Path:
+        """Return file path of key."""
+        return self.folder / f"{key}{RESULT_EXT}"
+
+    def get(self, key: str) -> Image:
+        """
+        Return stored image, or None if key is not in cache.
+
+        :param key: Cache key
+        :type key: str
+
+        :returns: RGB Image object or None
+        :rtype: Image
+        """
+        path = self.path(key)
+
+        try:
+            with Image.open(path) as img:
+                img.load()
+            os.utime(path)
+        except OSError: # missing, or removed by another process
+            return None
+
+        return img
+
+    def put(self, key: str, img: Image) -> None:
+        """
+        Store image and evict least recently used files over size limit.
+
+        :param key: Cache key
+        :type key: str
+        :param img: RGB Image object
+        :type img: Image
+        """
+        os.makedirs(self.folder, exist_ok=True)
+
+        path = self.path(key)
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.tmp{RESULT_EXT}")
+
+        img.save(tmp_path)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used files until size of cache fits in limit."""
+        entries = []
+        for path in self.folder.glob(f"*{RESULT_EXT}"):
+            if ".tmp" in path.name: # being written by another process
+                continue
+
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+
+        for mtime, file_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            size -= file_size
@@ -0,0 +1,459 @@
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qsl, urlparse
+import io
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+from PIL import Image
+
+from constants import *
+
+# Long running PixelSort server.
+# Jobs are sorted in a pool of warm worker processes. Jobs are sent with HTTP requests
+# over localhost TCP or Unix domain socket, files put in drop folder are sorted too.
+#
+# POST /sort with JSON body {"input": path, "output": path, "options": {...}}
+#   sorts file and returns JSON {"output": path, "seconds": time}, paths should be
+#   inside root folders set with --root
+# POST /sort?segmentation=chunky&... with image in body
+#   returns sorted image, format is set with "format" query parameter (PNG by default)
+# GET /status returns JSON with latency, queue depth and throughput
+
+def init_worker() -> None:
+    """
+    Import modules and register Pillow plugins once, before first job.
+    Workers live as long as server, so pixel_utils caches stay warm between jobs.
+    """
+    Image.init()
+
+    import api
+    try:
+        import numpy_sorting
+    except ImportError:
+        pass
+
+def parse_options(options: dict):
+    """
+    Convert dict with option values to SortOptions object.
+    Values may be strings (from query string), they are converted to field types.
+
+    :param options: Dict with option values, keys are long option names
+    :type options: dict
+
+    :returns: SortOptions object
+    """
+    from dataclasses import fields
+
+    import api
+
+    types = {field.name: field.type for field in fields(api.SortOptions)}
+
+    values = {}
+    for name, value in options.items():
+        if name not in types:
+            raise ValueError(f"Unknown option {name!r}")
+
+        if isinstance(value, str) and types[name] in (bool, "bool"):
+            value = value.lower() in ("1", "true", "yes")
+        elif isinstance(value, str) and types[name] in (int, "int"):
+            value = int(value)
+        elif isinstance(value, str) and types[name] in (float, "float"):
+            value = float(value)
+
+        values[name] = value
+
+    return api.SortOptions(**values)
+
+def run_job(job: dict):
+    """
+    Sort one job in worker process.
+
+    :param job: Dict with "options" and "input" path and "output" path,
+                or "data" with encoded image and "format" of output
+    :type job: dict
+
+    :returns: Output path or encoded output image
+    """
+    import api
+
+    options = parse_options(job.get("options", {}))
+
+    if "data" in job:
+        img = Image.open(io.BytesIO(job["data"]))
+    else:
+        img = Image.open(job["input"])
+
+    result = api.sort_image(img, options)
+
+    if "data" in job:
+        buffer = io.BytesIO()
+        result.save(buffer, format=job.get("format", "PNG"))
+        return buffer.getvalue()
+
+    os.makedirs(Path(job["output"]).parent, exist_ok=True)
+    result.save(job["output"], quality=95)
+    return job["output"]
+
+def check_path(path: str, roots: list) -> None:
+    """
+    Check that path is inside one of root folders after symlinks and ".." are resolved.
+
+    :param path: File path of job
+    :type path: str
+    :param roots: List of resolved root folders
+    :type roots: list
+
+    :raises PermissionError: If path is outside of roots
+    """
+    resolved = Path(path).resolve()
+    if not any(resolved.is_relative_to(root) for root in roots):
+        raise PermissionError(f"{path} is outside of root folders")
+
+class Stats(object):
+    """Job statistics of server."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+
+        self.queued = 0
+        self.done = 0
+        self.failed = 0
+
+        # (finish time, latency) of recent jobs
+        self.recent = deque(maxlen=SERVE_STATS_SIZE)
+
+    def submit(self) -> None:
+        """Count queued job."""
+        with self.lock:
+            self.queued += 1
+
+    def finish(self, latency: float, error: bool) -> None:
+        """Count finished job."""
+        with self.lock:
+            self.queued -= 1
+            if error:
+                self.failed += 1
+            else:
+                self.done += 1
+                self.recent.append((time.monotonic(), latency))
+
+    def status(self, workers: int) -> dict:
+        """Return statistics as dict."""
+        with self.lock:
+            now = time.monotonic()
+            latencies = sorted(latency for end_time, latency in self.recent)
+            last_minute = [end_time for end_time, latency in self.recent if now-end_time <= 60]
+
+            def percentile(p: float) -> float:
+                return round(latencies[min(int(len(latencies)*p), len(latencies)-1)], 3) if latencies else None
+
+            return {
+                "uptime": round(now-self.start_time, 3),
+                "workers": workers,
+                "queue_depth": self.queued,
+                "done": self.done,
+                "failed": self.failed,
+                "latency": {
+                    "mean": round(sum(latencies)/len(latencies), 3) if latencies else None,
+                    "p50": percentile(0.5),
+                    "p95": percentile(0.95),
+                    "max": round(latencies[-1], 3) if latencies else None
+                },
+                "throughput_per_minute": len(last_minute)
+            }
+
+class PixelSortServer(object):
+    """Pool of warm workers with HTTP interface and drop folder watch."""
+    def __init__(self, workers: int, logger: logging.Logger, roots: list=()):
+        """
+        :param workers: Number of worker processes, if zero, number of CPU cores
+        :type workers: int
+        :param logger: Logger object
+        :type logger: logging.Logger
+        :param roots: Folders which files of JSON jobs may be in, if empty, JSON jobs are refused
+        :type roots: list
+        """
+        self.workers = workers or os.cpu_count()
+        self.logger = logger
+        self.roots = [Path(root).resolve() for root in roots]
+        self.stats = Stats()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+        self.servers = []
+        self.stopped = threading.Event()
+
+    def sort(self, job: dict):
+        """
+        Run job in worker pool and wait for result.
+
+        :param job: Job dict, see run_job
+        :type job: dict
+
+        :returns: Result of run_job
+        """
+        start_time = time.monotonic()
+        self.stats.submit()
+
+        error = True
+        try:
+            result = self.executor.submit(run_job, job).result()
+            error = False
+            return result
+        finally:
+            self.stats.finish(time.monotonic()-start_time, error)
+
+    def sort_files(self, job: dict) -> str:
+        """
+        Run JSON job with input and output paths, paths are checked against root folders.
+
+        :param job: Job dict, see run_job
+        :type job: dict
+
+        :returns: Output path
+
+        :raises PermissionError: If there are no root folders or path is outside of them
+        """
+        if not self.roots:
+            raise PermissionError("JSON jobs are disabled, start server with --root")
+
+        for key in ("input", "output"):
+            check_path(job[key], self.roots)
+
+        return self.sort(job)
+
+    def serve_http(self, host: str, port: int) -> None:
+        """Start HTTP server on localhost TCP port in background thread."""
+        # pages in browser may reach localhost with other host name (DNS rebinding)
+        server = ThreadingHTTPServer((host, port), make_handler(self, SERVE_LOCAL_HOSTS + [host]))
+        self.start_server(server, f"http://{host}:{server.server_address[1]}")
+
+    def serve_unix(self, path: str) -> None:
+        """Start HTTP server on Unix domain socket in background thread, only owner can connect."""
+        if os.path.exists(path):
+            os.remove(path)
+
+        # socket is created with 0600 permissions, there is no moment when others can connect
+        umask = os.umask(0o177)
+        try:
+            server = ThreadingUnixHTTPServer(path, make_handler(self))
+        finally:
+            os.umask(umask)
+
+        self.start_server(server, f"unix:{path}")
+
+    def start_server(self, server, address: str) -> None:
+        """Run server in daemon thread."""
+        self.servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.logger.info(f"Listening on {address}")
+
+    def watch(self, folder: Path, output: Path, options: dict) -> None:
+        """
+        Sort every new file in folder and save it to output folder, runs in background thread.
+        File is sorted when its size did not change since previous check.
+
+        :param folder: Drop folder
+        :type folder: Path
+        :param output: Output folder
+        :type output: Path
+        :param options: Options of jobs
+        :type options: dict
+        """
+        supported_exts = list(Image.registered_extensions().keys())
+        sizes = {}
+        seen = set()
+
+        def loop() -> None:
+            while not self.stopped.wait(WATCH_INTERVAL):
+                paths = sorted(folder.iterdir())
+
+                # removed files are forgotten, so sets do not grow
+                seen.intersection_update(paths)
+                for path in set(sizes).difference(paths):
+                    del sizes[path]
+
+                for path in paths:
+                    if path in seen or path.suffix.lower() not in supported_exts or not path.is_file():
+                        continue
+
+                    try:
+                        size = path.stat().st_size
+                    except OSError:
+                        continue
+
+                    if sizes.get(path) != size:
+                        sizes[path] = size
+                        continue
+
+                    seen.add(path)
+                    del sizes[path]
+                    threading.Thread(target=self.sort_dropped, daemon=True,
+                                     args=(path, output / path.name, options)).start()
+
+        threading.Thread(target=loop, daemon=True).start()
+        self.logger.info(f"Watching {folder}, output is saved to {output}")
+
+    def sort_dropped(self, path: Path, output: Path, options: dict) -> None:
+        """Sort file from drop folder."""
+        try:
+            self.sort({"input": str(path), "output": str(output), "options": options})
+            self.logger.info(f"{path.name} done, saved to {output}")
+        except Exception as e:
+            self.logger.error(f"Failed to process {path.name}: {e!r}")
+
+    def stop(self) -> None:
+        """Stop servers, watch and workers."""
+        self.stopped.set()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+        self.executor.shutdown()
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """HTTP server on Unix domain socket, every request is handled in its own thread."""
+    daemon_threads = True
+
+def make_handler(app: PixelSortServer, allowed_hosts: list=None):
+    """
+    Create request handler class bound to server app.
+
+    :param app: PixelSortServer object
+    :type app: PixelSortServer
+    :param allowed_hosts: Accepted host names of Host header, if None, any host is accepted
+    :type allowed_hosts: list
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def address_string(self) -> str:
+            # Unix sockets have no client address
+            return str(self.client_address[0]) if self.client_address else "unix"
+
+        def log_message(self, format: str, *args) -> None:
+            app.logger.debug(f"{self.address_string()} {format % args}")
+
+        def send(self, code: int, body: bytes, content_type: str="application/json") -> None:
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, code: int, data: dict) -> None:
+            self.send(code, json.dumps(data).encode())
+
+        def check_host(self) -> bool:
+            """Check Host header and send error if host is not allowed."""
+            if allowed_hosts is None:
+                return True
+
+            host = urlparse(f"//{self.headers.get('Host', '')}").hostname
+            if host not in allowed_hosts:
+                self.send_json(403, {"error": "host is not allowed"})
+                return False
+
+            return True
+
+        def do_GET(self) -> None:
+            if not self.check_host():
+                return
+
+            if urlparse(self.path).path == "/status":
+                self.send_json(200, app.stats.status(app.workers))
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self) -> None:
+            if not self.check_host():
+                return
+
+            url = urlparse(self.path)
+            if url.path != "/sort":
+                self.send_json(404, {"error": "not found"})
+                return
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            try:
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    job = json.loads(body)
+                    if "input" not in job or "output" not in job:
+                        raise ValueError("Job should have input and output paths")
+
+                    start_time = time.monotonic()
+                    output = app.sort_files(job)
+                    self.send_json(200, {"output": output, "seconds": round(time.monotonic()-start_time, 3)})
+                else:
+                    options = dict(parse_qsl(url.query))
+                    img_format = options.pop("format", "PNG")
+                    # extensions like "jpg" are accepted too
+                    img_format = Image.registered_extensions().get(f".{img_format.lower()}", img_format.upper())
+                    if img_format not in Image.SAVE:
+                        raise ValueError(f"Unknown output format {img_format!r}")
+
+                    data = app.sort({"data": body, "format": img_format, "options": options})
+                    self.send(200, data, Image.MIME.get(img_format, "application/octet-stream"))
+            except PermissionError as e:
+                self.send_json(403, {"error": repr(e)})
+            except (ValueError, TypeError, OSError) as e:
+                self.send_json(400, {"error": repr(e)})
+            except Exception as e:
+                app.logger.error(f"Job failed: {e!r}")
+                self.send_json(500, {"error": repr(e)})
+
+    return Handler
+
+def main() -> None:
+    """Parse arguments and run server until interrupted."""
+    arg_parser = ArgumentParser(description=HELP_SERVE_DESCRIPTION)
+    arg_parser.add_argument("--host", default=SERVE_HOST, help=HELP_SERVE_HOST)
+    arg_parser.add_argument("--port", type=int, default=None, help=HELP_SERVE_PORT)
+    arg_parser.add_argument("--socket", default=None, help=HELP_SERVE_SOCKET)
+    arg_parser.add_argument("--root", action="append", default=[], help=HELP_SERVE_ROOT)
+    arg_parser.add_argument("--workers", type=int, default=0, help=HELP_SERVE_WORKERS)
+    arg_parser.add_argument("--watch", default=None, help=HELP_SERVE_WATCH)
+    arg_parser.add_argument("--watch-output", default=OPTION_DEFAULTS["output"], help=HELP_SERVE_WATCH_OUTPUT)
+    arg_parser.add_argument("--watch-options", default="{}", help=HELP_SERVE_WATCH_OPTIONS)
+    args = arg_parser.parse_args()
+
+    # outputs would be sorted again and overwrite inputs
+    if args.watch is not None and Path(args.watch).resolve() == Path(args.watch_output).resolve():
+        arg_parser.error("--watch-output should not be drop folder")
+
+    logger = logging.getLogger("pixelsort")
+    logger.setLevel("INFO")
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_RECORD_FORMAT))
+    logger.addHandler(handler)
+
+    watch_options = json.loads(args.watch_options)
+    parse_options(watch_options) # fail early on invalid options
+
+    server = PixelSortServer(args.workers, logger, args.root)
+
+    if args.socket is not None:
+        server.serve_unix(args.socket)
+    if args.port is not None or args.socket is None:
+        server.serve_http(args.host, args.port if args.port is not None else SERVE_PORT)
+    if args.watch is not None:
+        server.watch(Path(args.watch), Path(args.watch_output), watch_options)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stopped.set())
+
+    try:
+        server.stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Stopping...")
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import numpy as np
+
+# Sorting backends of NumpySortingEngine.
+# Every backend returns stable order of elements sorted by (segment id, key).
+# Segment ids are non-decreasing, so elements of every segment stay together.
+
+def is_narrow(keys) -> bool:
+    """Return True if keys are integers which fit in 16 bits."""
+    return keys.dtype.kind in "ui" and keys.dtype.itemsize <= 2 and (keys.size == 0 or keys.min() >= 0)
+
+def comparison_argsort(keys, segment_ids=None):
+    """
+    Sort with general stable argsort on composite (segment id, key) key.
+
+    :param keys: (N,) array of sorting keys
+    :param segment_ids: (N,) int64 array of segment ids, or None for one segment
+
+    :returns: (N,) array of indices
+    """
+    if segment_ids is None:
+        return np.argsort(keys, kind="stable")
+
+    if is_narrow(keys):
+        return np.argsort((segment_ids << (8*keys.dtype.itemsize)) | keys, kind="stable")
+
+    return np.lexsort((keys, segment_ids))
+
+def counting_argsort(keys, segment_ids=None):
+    """
+    Sort with least significant digit first counting sort passes.
+    Keys are sorted with one pass, segment ids with one pass per 16 bits.
+    Numpy uses counting (radix) sort for stable sorting of 8 and 16-bit integers:
+    histogram, prefix sum and scatter, so every pass is linear.
+
+    :param keys: (N,) array of 8 or 16-bit sorting keys
+    :param segment_ids: (N,) int64 array of segment ids, or None for one segment
+
+    :returns: (N,) array of indices
+    """
+    order = np.argsort(keys, kind="stable")
+
+    if segment_ids is None or segment_ids.size == 0:
+        return order
+
+    segment_ids = segment_ids[order]
+    max_id = int(segment_ids.max())
+
+    shift = 0
+    while max_id >> shift:
+        digit_order = np.argsort(((segment_ids >> shift) & 0xFFFF).astype(np.uint16), kind="stable")
+        order = order[digit_order]
+        segment_ids = segment_ids[digit_order]
+
+        shift += 16
+
+    return order
@@ -1,31 +1,118 @@
 import math
 import random
 
-from PIL import Image, ImageFilter
+from PIL import Image
 
+import edge_maps
+import key_expr
 import pixel_utils
+from metrics import Metrics
 from options import Options
 from utils import SortParams
 
 class SortingEngine:
     """Sorting engine class."""
-    def __init__(self, options: Options):
+    def __init__(self, options: Options, rng: random.Random=None):
+        """
+        :param options: Options object
+        :type options: Options
+        :param rng: Random number generator of random segmentations,
+                    if None, global generator of random module is used
+        :type rng: random.Random
+        """
         self.options = options
+        self.random = rng if rng is not None else random
+        # set by app if metrics are enabled
+        self.metrics = Metrics()
 
         self.image = None
         self.og_image_size = (0, 0)
         self.image_size = (0, 0)
         self.image_data = None
         self.edge_image_data = None
+        # 1 for every sortable pixel and 0 for pixels which are kept, or None if every pixel is sortable
+        self.mask_data = None
+
+        self.first_row = 0
+        self.channel = 0
+        self.chunky_offsets = [0, 0, 0]
+        self.input_key = None
 
         self.skey = None
 
+    def close(self) -> None:
+        """Release resources of engine."""
+        pass
+
     def make_symmetrical(self, array):
         """Make symmetrical if self.sm==True"""
         if self.sm:
-            return array[::2] + array[::-2]
+            return array[::2] + array[1::2][::-1]
         return array
 
+    def sort_slice(self, row: list, begin: int, end: int, reverse: bool, row_start: int) -> None:
+        """
+        Sort row[begin:end] in place. Pixels outside of mask are not sorted,
+        they split slice to runs which are sorted separately.
+
+        :param row: List of pixels of row
+        :type row: list
+        :param begin: Slice start, like in row[begin:end]
+        :type begin: int
+        :param end: Slice end, like in row[begin:end]
+        :type end: int
+        :param reverse: Reverse flag
+        :type reverse: bool
+        :param row_start: Index of first pixel of row in image data
+        :type row_start: int
+        """
+        if self.mask_data is None:
+            row[begin:end] = self.make_symmetrical(sorted(row[begin:end], key=self.skey, reverse=reverse))
+            return
+
+        begin, end, _ = slice(begin, end).indices(len(row))
+        for run_start, run_end in self.mask_runs(row_start+begin, row_start+end):
+            run_begin, run_end = run_start-row_start, run_end-row_start
+            row[run_begin:run_end] = self.make_symmetrical(sorted(row[run_begin:run_end], key=self.skey, reverse=reverse))
+
+    def mask_runs(self, start: int, end: int):
+        """
+        Yield runs of sortable pixels in image_data[start:end].
+
+        :param start: Start index
+        :type start: int
+        :param end: End index
+        :type end: int
+
+        :returns: Iterator of (start, end) tuples, whole range if there is no mask
+        """
+        if self.mask_data is None:
+            if start < end:
+                yield (start, end)
+            return
+
+        while start < end:
+            run_start = self.mask_data.find(1, start, end)
+            if run_start == -1:
+                return
+
+            run_end = self.mask_data.find(0, run_start, end)
+            if run_end == -1:
+                run_end = end
+
+            yield (run_start, run_end)
+            start = run_end
+
+    def prepare_bounds(self) -> None:
+        """Precalculate values used by calc_bounds."""
+        self.sin_alpha = math.sin(math.radians(self.sort_params.a%90))
+        self.sin_beta = math.sin(math.radians(90-(self.sort_params.a%90)))
+
+        self.x1 = self.og_image_size[(self.sort_params.a//90)%2]*self.sin_beta
+        self.y1 = self.og_image_size[(self.sort_params.a//90)%2]*self.sin_alpha
+        self.x2 = self.image_size[0]-self.x1
+        self.y2 = self.image_size[1]-self.y1
+
     def calc_bounds(self, y: int) -> tuple:
         """
         Calculate bounds for sorting. It prevents sorting black parts of image when angle is nonzero.
@@ -46,7 +133,8 @@ class SortingEngine:
 
         return (start, end, yoffset+start, yoffset+end)
 
-    def sort_image(self, *, sort_params: SortParams, image: Image, og_image_size: tuple) -> None:
+    def sort_image(self, *, sort_params: SortParams, image: Image, og_image_size: tuple,
+                   first_row: int=0, continued: bool=False, input_key=None, mask: Image=None) -> None:
         """
         Sort image.
 
@@ -56,26 +144,36 @@ class SortingEngine:
         :type image: Image
         :param og_image_size: Original image size
         :type og_image_size: tuple
+        :param first_row: Number of first row, if image is a strip of bigger image
+        :type first_row: int
+        :param continued: If True, image is next strip of the same image and
+                          state of chunky segmentation is carried over from previous strip
+        :type continued: bool
+        :param input_key: Hashable key of image content, images with the same key have the same
+                          content, so their edge maps are reused. If None, content is not known.
+        :param mask: "L" Image of the same size as image, pixels with value 0 are not sorted
+                     and split segments. If None, every pixel is sorted.
+        :type mask: Image
         """
 
         self.sort_params = sort_params
         self.image = image
         self.og_image_size = og_image_size
+        self.input_key = input_key
+        self.mask_data = mask.tobytes() if mask is not None else None
 
         self.image_data = list(self.image.getdata())
         self.image_size = self.image.size
 
-        self.sin_alpha = math.sin(math.radians(self.sort_params.a%90))
-        self.sin_beta = math.sin(math.radians(90-(self.sort_params.a%90)))
-
-        self.x1 = self.og_image_size[(self.sort_params.a//90)%2]*self.sin_beta
-        self.y1 = self.og_image_size[(self.sort_params.a//90)%2]*self.sin_alpha
-        self.x2 = self.image_size[0]-self.x1
-        self.y2 = self.image_size[1]-self.y1
+        self.prepare_bounds()
 
-        self.chunky_offset = 0
+        # channel is index of sorted channel with decompose flag
+        self.first_row = first_row
+        self.channel = 0
+        if not continued:
+            self.chunky_offsets = [0, 0, 0]
 
-        self.skey = getattr(pixel_utils, self.options.sk.value)
+        self.skey = self.get_skey()
         self.re = self.options.re.value
         self.sm = self.options.sm.value
 
@@ -83,45 +181,82 @@ class SortingEngine:
             og_image_data = self.image_data.copy()
 
             # red
+            self.channel = 0
             self.image_data = [(i[0], 0, 0) for i in og_image_data]
-            getattr(self, self.options.sg.value+"_sort")()
+            self.run_segmentation()
             self.image_data = [(self.image_data[i][0], og_image_data[i][1], og_image_data[i][2]) for i in range(len(og_image_data))]
             og_image_data = self.image_data.copy()
 
             # green
+            self.channel = 1
             self.image_data = [(0, i[1], 0) for i in og_image_data]
-            getattr(self, self.options.sg.value+"_sort")()
+            self.run_segmentation()
             self.image_data = [(og_image_data[i][0], self.image_data[i][1], og_image_data[i][2]) for i in range(len(og_image_data))]
             og_image_data = self.image_data.copy()
 
             # blue
+            self.channel = 2
             self.image_data = [(0, 0, i[2]) for i in og_image_data]
-            getattr(self, self.options.sg.value+"_sort")()
+            self.run_segmentation()
             self.image_data = [(og_image_data[i][0], og_image_data[i][1], self.image_data[i][2]) for i in range(len(og_image_data))]
             og_image_data = self.image_data.copy()
         else:
             # execute sort method
-            getattr(self, self.options.sg.value+"_sort")()
+            self.run_segmentation()
 
         self.image.putdata(self.image_data)
 
         self.image_data = None
         self.edge_image_data = None
+        self.mask_data = None
+
+    def run_segmentation(self) -> None:
+        """Run sort method of segmentation selected in options."""
+        with self.metrics.stage("sort", method=self.options.sg.value):
+            getattr(self, self.options.sg.value+"_sort")()
+
+    def get_skey(self):
+        """Return sorting key function, which takes pixel tuple and returns int from 0 to 255."""
+        if self.options.se.value:
+            return key_expr.python_key(self.options.se.value)
+
+        return getattr(pixel_utils, self.options.sk.value)
+
+    def bucket_pixels(self, image: Image) -> list:
+        """
+        Split pixels of image to buckets by sorting key, used to sort big images
+        with none segmentation out of memory.
+
+        :param image: RGB Image object
+        :type image: Image
+
+        :returns: List of 256 bytes objects with raw pixels of every key in original order
+        :rtype: list
+        """
+        skey = self.get_skey()
+
+        buckets = [bytearray() for i in range(256)]
+        for pixel in image.getdata():
+            buckets[skey(pixel)] += bytes(pixel)
+
+        return buckets
 
     def none_sort(self) -> None:
         """Sort with none segmentation."""
-        to_sort = []
+        # rows, or runs of sortable pixels of rows if there is mask
+        runs = []
         for y in range(self.image_size[1]):
             rstart, rend, start, end = self.calc_bounds(y)
+            runs.extend(self.mask_runs(start, end) if self.mask_data is not None else [(start, end)])
 
+        to_sort = []
+        for start, end in runs:
             to_sort.extend(self.image_data[start:end])
 
         to_sort.sort(key=self.skey, reverse=self.re)
 
         index = 0
-        for y in range(self.image_size[1]):
-            rstart, rend, start, end = self.calc_bounds(y)
-
+        for start, end in runs:
             self.image_data[start:end] = self.make_symmetrical(to_sort[index:index+end-start])
             index += end-start
 
@@ -133,17 +268,21 @@ class SortingEngine:
             rstart, rend, start, end = self.calc_bounds(y)
 
             row = self.image_data[start:end]
-            row.sort(key=self.skey, reverse=self.re)
 
-            if self.sm:
-                row = self.make_symmetrical(row)
+            if self.mask_data is not None:
+                self.sort_slice(row, 0, len(row), self.re, start)
+            else:
+                row.sort(key=self.skey, reverse=self.re)
+
+                if self.sm:
+                    row = self.make_symmetrical(row)
 
             self.image_data[start:end] = row
             # it works faster than accessing self.image_data directly
 
     def edge_sort(self) -> None:
         """Sort with edge segmentation."""
-        self.edge_image_data = list(self.image.filter(ImageFilter.FIND_EDGES).getdata())
+        self.edge_image_data = edge_maps.get_edge_map(self.image, self.options.ed.value, self.input_key)
 
         t = self.sort_params.t
         of = self.sort_params.of
@@ -151,17 +290,20 @@ class SortingEngine:
         for y in range(self.image_size[1]):
             rstart, rend, start, end = self.calc_bounds(y)
 
+            # rows without sortable pixels have no segments
+            if self.mask_data is not None and self.mask_data.find(1, start, end) == -1:
+                continue
+
             row = self.image_data[start:end]
             edge_row = self.edge_image_data[start:end]
 
             segment_begin = 0
-            for x in range(len(row)):
-                if pixel_utils.lightness(edge_row[min(x-of, len(row)-1)]) > t*255 or x==len(row)-1:
-                    if x - segment_begin > 1:
-                        row[segment_begin:x] = self.make_symmetrical(sorted(row[segment_begin:x], key=self.skey, reverse=self.re))
+            for x in edge_maps.row_boundaries(edge_row, t, of):
+                if x - segment_begin > 1:
+                    self.sort_slice(row, segment_begin, x, self.re, start)
 
-                    if x != 0:
-                        segment_begin = x+1
+                if x != 0:
+                    segment_begin = x+1
 
             self.image_data[start:end] = row
 
@@ -173,14 +315,14 @@ class SortingEngine:
             rstart, rend, start, end = self.calc_bounds(y)
 
             row = self.image_data[start:end]
-            width = sz*self.og_image_size[0]*(1-(0.5*(random.random()+0.5)))
+            width = sz*self.og_image_size[0]*(1-(0.5*(self.random.random()+0.5)))
 
             x = 0
             while x < len(row):
                 last_x = round(x)
-                x += width*random.random() if x == 0 else width
+                x += width*self.random.random() if x == 0 else width
 
-                row[last_x:round(x)] = self.make_symmetrical(sorted(row[last_x:round(x)], key=self.skey, reverse=self.re))
+                self.sort_slice(row, last_x, round(x), self.re, start)
 
             self.image_data[start:end] = row
 
@@ -195,7 +337,7 @@ class SortingEngine:
             row = self.image_data[start:end]
 
             block_size = sz*self.og_image_size[0]
-            offset = round(block_size*r*(random.random() - 0.5))
+            offset = round(block_size*r*(self.random.random() - 0.5))
 
             x = (rstart//block_size)*block_size
             first_iter = True
@@ -209,8 +351,8 @@ class SortingEngine:
                 if max(0, rend-x) <= -offset+1:
                     x -= offset
 
-                row[last_x:round(x)-rstart] = self.make_symmetrical(sorted(row[last_x:round(x)-rstart], key=self.skey,
-                    reverse=(y//block_size)%2 != self.re))
+                self.sort_slice(row, last_x, round(x)-rstart,
+                                ((self.first_row+y)//block_size)%2 != self.re, start)
 
 
                 first_iter = False
@@ -222,7 +364,7 @@ class SortingEngine:
         l = self.sort_params.l
         r = self.sort_params.r
 
-        chunky_offset = 0
+        chunky_offset = self.chunky_offsets[self.channel]
 
         for y in range(self.image_size[1]):
             rstart, rend, start, end = self.calc_bounds(y)
@@ -237,14 +379,15 @@ class SortingEngine:
 
             while x < len(row):
                 last_offset = offset
-                offset = round(l*r*(random.random() - 0.5))
+                offset = round(l*r*(self.random.random() - 0.5))
 
                 last_x = round(max(x, 0))
                 x += l
 
-                row[last_x+last_offset:round(x+offset)] = self.make_symmetrical(sorted(row[last_x+last_offset:round(x+offset)], key=self.skey,
-                    reverse=self.re))
+                self.sort_slice(row, last_x+last_offset, round(x+offset), self.re, start)
 
             chunky_offset = (((((len(row) - chunky_offset) // l)+1) * l) + chunky_offset) % len(row)
 
             self.image_data[start:end] = row
+
+        self.chunky_offsets[self.channel] = chunky_offset
@@ -0,0 +1,182 @@
+import struct
+import zlib
+from pathlib import Path
+
+from PIL import Image
+
+# Reading and writing images in horizontal strips, so whole image is never in memory.
+
+STRIP_WRITER_EXTS = [".png", ".ppm", ".pnm"]
+
+class StripReader(object):
+    """
+    Image reader which decodes only rows of requested strip.
+    Uncompressed images (PPM, BMP, uncompressed TIFF with one or many strips or tiles)
+    are read directly from file. Other images can not be decoded partially (streamable
+    is False), they are decoded once and kept in memory.
+    """
+    def __init__(self, file_path: Path):
+        """
+        :param file_path: Image file path
+        :type file_path: Path
+        """
+        self.file_path = file_path
+
+        img = Image.open(file_path)
+        self.size = img.size
+        self.mode = img.mode
+        self.tile = [tuple(tile) for tile in img.tile]
+        img.close()
+
+        self.image = None
+        # palette is read only when whole image is loaded
+        self.streamable = (self.mode != "P" and bool(self.tile)
+                           and all(tile[0] == "raw" for tile in self.tile))
+
+    def read(self, y0: int, y1: int) -> Image:
+        """
+        Read strip of rows.
+
+        :param y0: First row
+        :type y0: int
+        :param y1: Row after last row
+        :type y1: int
+
+        :returns: RGB Image object
+        :rtype: Image
+        """
+        if not self.streamable:
+            if self.image is None:
+                self.image = Image.open(self.file_path)
+                self.image.load()
+
+            return self.image.crop((0, y0, self.size[0], y1)).convert("RGB")
+
+        strip = Image.new(self.mode, (self.size[0], y1-y0))
+
+        with open(self.file_path, "rb") as f:
+            for codec, (x0, ty0, x1, ty1), offset, args in self.tile:
+                # rows of tile which are in strip
+                r0, r1 = max(ty0, y0), min(ty1, y1)
+                if r0 >= r1:
+                    continue
+
+                rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else (tuple(args)+(0, 1))[:3]
+                if stride == 0:
+                    stride = len(Image.new(self.mode, (x1-x0, 1)).tobytes())
+
+                # bottom-up images store last row first
+                first = r0-ty0 if orientation > 0 else ty1-r1
+
+                f.seek(offset+first*stride)
+                data = f.read((r1-r0)*stride)
+                strip.paste(Image.frombytes(self.mode, (x1-x0, r1-r0), data, "raw",
+                                            rawmode, stride, orientation), (x0, r0-y0))
+
+        return strip.convert("RGB")
+
+    def close(self) -> None:
+        """Release decoded image."""
+        self.image = None
+
+class StripWriter(object):
+    """Writer of RGB image which encodes rows as they come."""
+    def __init__(self, file_path: Path, size: tuple):
+        """
+        :param file_path: Output file path
+        :type file_path: Path
+        :param size: Size of whole image
+        :type size: tuple
+        """
+        self.file_path = file_path
+        self.size = size
+        self.rows = 0
+
+        self.file = open(file_path, "wb")
+        self.write_header()
+
+    def write(self, img: Image) -> None:
+        """
+        Write strip below previously written strips.
+
+        :param img: RGB Image object with the same width as whole image
+        :type img: Image
+        """
+        self.write_rows(img.tobytes(), img.size[1])
+        self.rows += img.size[1]
+
+    def close(self) -> None:
+        """Finish and close file."""
+        try:
+            if self.rows != self.size[1]:
+                raise ValueError(f"{self.rows} rows written, image has {self.size[1]} rows")
+
+            self.write_trailer()
+        finally:
+            self.file.close()
+
+    def abort(self) -> None:
+        """Close file without finishing it, does nothing if file is closed."""
+        self.file.close()
+
+    def write_header(self) -> None:
+        """Write file header."""
+        pass
+
+    def write_rows(self, data: bytes, count: int) -> None:
+        """Write count rows of raw RGB data."""
+        self.file.write(data)
+
+    def write_trailer(self) -> None:
+        """Write end of file."""
+        pass
+
+class PPMWriter(StripWriter):
+    """Binary PPM writer."""
+    def write_header(self) -> None:
+        self.file.write(f"P6\n{self.size[0]} {self.size[1]}\n255\n".encode())
+
+class PNGWriter(StripWriter):
+    """PNG writer, rows are compressed with one zlib stream split into IDAT chunks."""
+    def write_header(self) -> None:
+        self.compressor = zlib.compressobj(6)
+
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel, RGB, no interlace
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", *self.size, 8, 2, 0, 0, 0))
+
+    def write_rows(self, data: bytes, count: int) -> None:
+        stride = self.size[0]*3
+
+        # every row starts with filter type 0 (none)
+        rows = b"".join(b"\x00" + data[y*stride:(y+1)*stride] for y in range(count))
+        self.write_chunk(b"IDAT", self.compressor.compress(rows))
+
+    def write_trailer(self) -> None:
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+
+    def write_chunk(self, chunk_type: bytes, data: bytes) -> None:
+        """Write PNG chunk, empty IDAT chunks are skipped."""
+        if chunk_type == b"IDAT" and not data:
+            return
+
+        self.file.write(struct.pack(">I", len(data)) + chunk_type + data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+def get_strip_writer(file_path: Path, size: tuple) -> StripWriter:
+    """
+    Create strip writer for file extension.
+
+    :param file_path: Output file path
+    :type file_path: Path
+    :param size: Size of whole image
+    :type size: tuple
+
+    :returns: StripWriter object
+    :rtype: StripWriter
+    """
+    if Path(file_path).suffix.lower() == ".png":
+        return PNGWriter(file_path, size)
+
+    return PPMWriter(file_path, size)